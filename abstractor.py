@@ -3,63 +3,121 @@
 This class contains the bot's handling of discord events.
 """
 
+import asyncio
 import logging
 import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 import discord
 import config
 import messages
-from parsing.common import GlobalParser
+from scheduler import FetchScheduler, SchedulerBusy
+from parsing.cache import backfill_budget, metadata_cache
+from parsing.common import GlobalParser, LINK_PATTERN, FetchError
+from parsing.registry import AO3_MATCH
+from parsing.store import JsonStore
 
 # Import the logger from another file
 logger = logging.getLogger('discord')
 
-# Sites that the bot should attempt to parse links from
-# The parser is ultimately responsible for determining if a link is valid,
-# but this is used as a first pass to avoid unnecessary parsing.
-# Exclude any prefixes (http://, https://, www.) and any subdomains (m., forums.) from this list.
-VALID_SITES = [
-    "archiveofourown.org",
-    "fanfiction.net",
-    "spacebattles.com"
-]
-
-# The regular expression to identify possible website links
-# matches https://, then an optional subdomain, then a site name, then any non-whitespace characters
-# the negative lookahead prevents the bot from responding to links that start with the prefix (! by default)
-LINK_PATTERN = re.compile(
-    "(?<!{})https?://(?:\\S*\\.)?(?:{})\\S*".format(
-        re.escape(config.prefix), "|".join([re.escape(link) for link in VALID_SITES])))
-
 # dictionary of emoji to numbers, for parsing reacts
 REACTS = {"1️⃣": 1, "2️⃣": 2, "3️⃣": 3, "4️⃣": 4, "5️⃣": 5,
           "6️⃣": 6, "7️⃣": 7, "8️⃣": 8, "9️⃣": 9, "🔟": 10}
 
+# matches the backfill command, with an optional number of days to go back
+BACKFILL_PATTERN = re.compile(r"\bbackfill(?:\s+(\d+))?")
+
+# a single thread does backfill fetches, so they never crowd out links people are waiting on
+backfill_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backfill")
+
+# guild owner id -> owner's name, so restarts don't have to fetch every owner again
+guild_owners = JsonStore(config.guild_owner_file)
+
+
+def _describe_guild(guild, owner) -> str:
+    """Return a guild's id, name, owner and owner id as a line for the log."""
+    return "{}\t{}\t{}\t{}".format(guild.id, guild.name, owner, guild.owner_id)
+
 
 class Abstractor(discord.Client):
     """The discord bot client itself."""
 
+    async def setup_hook(self):
+        """Start the fetch scheduler before connecting to discord."""
+        self.scheduler = FetchScheduler()
+        # message id -> {unique id: summary sent for it}, for the most recent messages the bot replied to
+        self._replies = OrderedDict()
+        # the task logging the servers the bot is in, started by on_ready
+        self._inventory = None
+        # the running backfill, if any. Only one runs at a time, since they share a single thread and budget
+        self._backfill = None
+        self.loop.create_task(self.scheduler.report())
+
+    async def close(self):
+        """Stop the fetch workers when the bot shuts down."""
+        await super().close()
+        # setup_hook doesn't run if the bot fails to log in
+        if hasattr(self, "scheduler"):
+            self.scheduler.shutdown()
+
     async def on_ready(self):
         """When starting bot, print the servers it is part of."""
-        s = "Logged on!\nMember of:\n"
-        for guild in self.guilds:
-            owner = await self.fetch_user(guild.owner_id)
-            s += "{}\t{}\t{}\t{}\n".format(
-                guild.id, guild.name, owner, guild.owner_id)
-        logger.info(s)
+        # on_ready runs again after reconnects, so don't start a second inventory while one is running
+        if self._inventory is None or self._inventory.done():
+            self._inventory = self.loop.create_task(self.log_inventory())
+
+    async def log_inventory(self):
+        """Log every server the bot is in, with its owner, without holding up messages."""
+        start = time.monotonic()
+        logger.info("Logged on! Member of {} guilds:".format(len(self.guilds)))
+        limit = asyncio.Semaphore(config.owner_lookup_concurrency)
+        fetched = {}
+
+        async def describe(guild):
+            async with limit:
+                owner = await self._owner_name(guild, fetched)
+            logger.info(_describe_guild(guild, owner))
+
+        await asyncio.gather(*(describe(guild) for guild in self.guilds))
+        if fetched:
+            await asyncio.to_thread(guild_owners.update, fetched)
+        logger.info("Listed {} guilds in {:.1f} seconds, fetching {} owners".format(
+            len(self.guilds), time.monotonic() - start, len(fetched)))
+
+    async def _owner_name(self, guild, fetched=None) -> str:
+        """Return the name of a guild's owner.
+
+        Owners are taken from discord's member cache, then from guild_owners,
+        and only fetched if neither has them. Fetched names are added to fetched if given,
+        or saved to guild_owners straight away if not.
+        """
+        if guild.owner is not None:
+            return str(guild.owner)
+        key = str(guild.owner_id)
+        if key in guild_owners:
+            return guild_owners.get(key)
+        try:
+            owner = str(await self.fetch_user(guild.owner_id))
+        except discord.HTTPException:
+            logger.exception("Couldn't fetch the owner of guild {}".format(guild.id))
+            return "unknown"
+        if fetched is not None:
+            fetched[key] = owner
+        else:
+            await asyncio.to_thread(guild_owners.set, key, owner)
+        return owner
 
     async def on_guild_join(self, guild):
         """Print a message when the bot is added to a server."""
-        logger.info("Joined a new guild!\n")
-        owner = await self.fetch_user(guild.owner_id)
-        s = "\t".join((guild.id, guild.name, owner, guild.owner_id))
-        logger.info(s)
+        logger.info("Joined a new guild!")
+        logger.info(_describe_guild(guild, await self._owner_name(guild)))
 
     async def on_guild_remove(self, guild):
         """Print a message when the bot is removed a server."""
         logger.info("Removed from a guild.")
-        owner = await self.fetch_user(guild.owner_id)
-        s = "\t".join((guild.id, guild.name, owner, guild.owner_id))
-        logger.info(s)
+        logger.info(_describe_guild(guild, await self._owner_name(guild)))
 
     async def on_message(self, message):
         """Parse messages and respond if they contain a fanfiction link."""
@@ -77,6 +135,13 @@ class Abstractor(discord.Client):
             if "help" in content or "info" in content:
                 output = messages.introduction(message.guild.id)
                 await message.channel.send(output)
+            elif (match := BACKFILL_PATTERN.search(content)) and message.author.guild_permissions.manage_guild:
+                if self._backfill is not None and not self._backfill.done():
+                    await message.channel.send(messages.BACKFILL_RUNNING_MESSAGE)
+                    return
+                days = int(match.group(1)) if match.group(1) else config.backfill_max_days
+                self._backfill = self.loop.create_task(self.backfill(message, min(days, config.backfill_max_days)))
+                return
 
         # if a bot message is replied to with "delete", delete the message and exit early
         if message.guild.id not in config.servers_no_deletion:
@@ -84,12 +149,14 @@ class Abstractor(discord.Client):
                 if message.reference.resolved.author == self.user:
                     if message.content == "delete":
                         await message.reference.resolved.delete()
+                        self._forget_reply(message.reference.resolved.id)
                         return
 
         # check for valid links
         possible_links = LINK_PATTERN.finditer(content)
         global_parser = GlobalParser()
         parsed_links = 0
+        busy = False
         for link in possible_links:
             # make sure we don't parse more links than we'll send:
             if parsed_links >= config.max_links:
@@ -99,20 +166,168 @@ class Abstractor(discord.Client):
             if global_parser.is_valid_link(link.group(0)):
                 async with message.channel.typing():
                     try:
-                        parsed_item = global_parser.parse(link.group(0))
-                        if parsed_item:
+                        if await self._parse_link(message, global_parser, link.group(0)):
                             parsed_links += 1
-                    except Exception:
-                        logger.exception("Failed to parse link: {}".format(link.group(0)))
+                    except SchedulerBusy:
+                        busy = True
+                        break
 
         number_sent = 0
-        if parsed_links > 0:
-            for summary in global_parser.generate_summaries(config.max_links):
-                if number_sent > 1:
-                    summary = "** **\n" + summary
-                number_sent += 1
-                await message.channel.send(summary)
+        replies = {}
+        for unique_id, parsed in global_parser.parsed_items[:config.max_links]:
+            summary = parsed.generate_summary()
+            if number_sent > 1:
+                summary = "** **\n" + summary
+            number_sent += 1
+            replies[unique_id] = await message.channel.send(summary)
+        if busy:
+            await message.channel.send(messages.BUSY_MESSAGE)
+        self._remember_replies(message.id, replies)
+
+    async def on_message_edit(self, before, after):
+        """Summarize links that were added to a message by editing it.
+
+        Links that were already in the message aren't summarized again. If a link the bot summarized
+        was edited out of the message, that summary is edited to show one of the new links instead.
+        """
+        if before.content == after.content or after.guild is None:
+            return
+        if after.author == self.user:
+            return
+        if after.author.bot and after.author.id not in config.bots_allow:
+            return
+
+        global_parser = GlobalParser()
+        before_links = self._find_links(before.content, global_parser)
+        after_links = self._find_links(after.content, global_parser)
+        replies = self._replies.get(after.id, {})
+        added = [(unique_id, link) for unique_id, link in after_links.items()
+                 if unique_id not in before_links and unique_id not in replies]
+        if not added:
+            return
+
+        # summaries of links that are no longer in the message can be reused for new links
+        removed = [unique_id for unique_id in replies if unique_id not in after_links]
+        room = config.max_links - len(replies) + len(removed)
+        for unique_id, link in added[:room]:
+            async with after.channel.typing():
+                try:
+                    parsed = await self._parse_link(after, global_parser, link)
+                except SchedulerBusy:
+                    await after.channel.send(messages.BUSY_MESSAGE)
+                    break
+            if not parsed:
+                continue
+            summary = parsed.generate_summary()
+            if removed:
+                reply = replies.pop(removed.pop(0))
+                try:
+                    await reply.edit(content=summary)
+                except discord.NotFound:
+                    # the summary was deleted some other way since it was sent
+                    reply = await after.channel.send(summary)
+            else:
+                reply = await after.channel.send(summary)
+            replies[unique_id] = reply
+        self._remember_replies(after.id, replies)
+
+    async def _parse_link(self, message, global_parser, link):
+        """Parse a link from a message through the fetch scheduler.
+
+        Returns the parsed object, or None if the link couldn't be parsed.
+        Raises SchedulerBusy if the bot is too busy to parse it now.
+        """
+        try:
+            return await self.scheduler.submit(message.guild.id, message.author.id, global_parser.parse, link)
+        except SchedulerBusy as e:
+            logger.info("Too busy to parse link: {} ({})".format(link, e))
+            raise
+        except FetchError as e:
+            logger.info("Could not fetch link: {} ({}: {})".format(link, e.failure, e))
+        except Exception:
+            logger.exception("Failed to parse link: {}".format(link))
+        return None
+
+    @staticmethod
+    def _find_links(content, global_parser) -> dict[str, str]:
+        """Find the valid links in a message. Returns a dict of unique id to link, in message order."""
+        links = {}
+        for link in LINK_PATTERN.finditer(content.lower()):
+            unique_id = global_parser.unique_id(link.group(0))
+            if unique_id and unique_id not in links:
+                links[unique_id] = link.group(0)
+        return links
+
+    def _remember_replies(self, message_id, replies):
+        """Remember which summaries were sent for a message, so edits to it can be handled."""
+        if not replies:
+            return
+        self._replies[message_id] = replies
+        self._replies.move_to_end(message_id)
+        while len(self._replies) > config.tracked_messages:
+            self._replies.popitem(last=False)
+
+    def _forget_reply(self, reply_id):
+        """Stop tracking a summary that was deleted, so edits to its message don't try to reuse it."""
+        for message_id, replies in self._replies.items():
+            for unique_id, reply in replies.items():
+                if reply.id == reply_id:
+                    del replies[unique_id]
+                    if not replies:
+                        del self._replies[message_id]
+                    return
+
+    async def backfill(self, message, days):
+        """Walk back through a channel's history and load every linked work into the cache.
+
+        Nothing is posted; progress is logged, and the command message is reacted to when done.
+        """
+        channel = message.channel
+        after = discord.utils.utcnow() - timedelta(days=days)
+        logger.info("Starting backfill of #{} in {} ({} days)".format(channel.name, channel.guild.name, days))
+        await message.add_reaction("🔄")
+
+        global_parser = GlobalParser()
+        loop = asyncio.get_running_loop()
+        seen = set()
+        fetches = []
+        scanned = 0
+        async for old_message in channel.history(limit=config.backfill_max_messages, after=after,
+                                                 oldest_first=False):
+            scanned += 1
+            for link in LINK_PATTERN.finditer(old_message.content.lower()):
+                unique_id = global_parser.unique_id(link.group(0))
+                if unique_id and unique_id not in seen:
+                    seen.add(unique_id)
+                    fetches.append(loop.run_in_executor(
+                        backfill_executor, self._backfill_fetch, global_parser, link.group(0)))
+            if scanned % config.backfill_progress_interval == 0:
+                logger.info("Backfill of #{}: scanned {} messages, found {} links".format(
+                    channel.name, scanned, len(seen)))
+            if len(seen) >= config.backfill_max_links:
+                logger.info("Backfill of #{} reached {} links, stopping".format(channel.name, len(seen)))
+                break
+
+        results = await asyncio.gather(*fetches)
+        logger.info("Finished backfill of #{}: scanned {} messages, cached {} of {} links".format(
+            channel.name, scanned, sum(results), len(seen)))
+        await message.remove_reaction("🔄", self.user)
+        await message.add_reaction("✅")
 
+    @staticmethod
+    def _backfill_fetch(global_parser, link) -> bool:
+        """Load a single link into the cache, within the backfill request budget."""
+        backfill_budget.acquire()
+        try:
+            parsed = global_parser.parse(link)
+            if parsed:
+                metadata_cache.extend(global_parser.unique_id(link), config.backfill_ttl)
+            return bool(parsed)
+        except FetchError:
+            return False
+        except Exception:
+            logger.exception("Failed to backfill link: {}".format(link))
+            return False
 
     async def on_reaction_add(self, reaction, user):
         """If react is added to bot's series message, send work information.
@@ -120,27 +335,29 @@ class Abstractor(discord.Client):
         This can be disabled per server in config.py.
         """
         # todo: consider whether the logic should be moved to the parser
-        from parsing.ao3 import AO3_MATCH, AO3SeriesWrapper
         if reaction.message.guild.id in config.servers_no_reacts:
             return
         if reaction.message.author != self.user or reaction.count != 1:
             return
         content = reaction.message.content
         match = AO3_MATCH.search(content)
-        link_type = match.group(1)
-        if link_type != "series":
+        if not match or match.group(1) != "series":
             return
 
         fic = REACTS.get(reaction.emoji)
         if not fic:
             return
 
-        series = AO3SeriesWrapper(match.group(2))
         output = ""
         async with reaction.message.channel.typing():
             try:
-                work = series.get_work(fic)
+                # the series is usually still cached from when the message was sent
+                work = await self.scheduler.submit(
+                    reaction.message.guild.id, user.id,
+                    lambda: GlobalParser().parse(match.group(0)).get_work(fic))
                 output = work.generate_summary()
+            except SchedulerBusy:
+                output = messages.BUSY_MESSAGE
             except Exception:
                 logger.exception("Failed to generate summary for work in series")
         if len(output) > 0:
@@ -2,7 +2,7 @@
 
 """This is a duplicate of the Fanfic Rec Bot, but it works better.
 
-Required files are: bot.py, config.py, abstractor.py, messages.py, and the parsing package.
+Required files are: bot.py, config.py, abstractor.py, messages.py, scheduler.py, and the parsing package.
 To run the bot, execute bot.py and leave it running.
 
 config.py must contain the bot token as a variable, token.
@@ -18,20 +18,90 @@ quihi, sovdeeth
 
 import abstractor
 import config
+import copy
 import discord
+import json
 import logging
+import logging.handlers
+import queue
+import sys
+from parsing import cache
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats log records as one JSON object per line."""
+
+    def format(self, record):
+        """Return the record as a JSON string."""
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Puts log records on a queue, keeping their traceback separate from the message.
+
+    QueueHandler folds the traceback into the message, which would leave the JSON logs without
+    an exception field. The traceback is still formatted here rather than by the listener,
+    since the exception may have changed by the time the listener gets to it.
+    """
+
+    def prepare(self, record):
+        """Return a copy of the record with its message and traceback formatted."""
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+def setup_logging():
+    """Send the bot's logs to a rotating file, written by a background thread.
+
+    Log calls only put the record on a queue, so they never wait for the disk.
+    Returns the listener that writes the file; stop it before exiting to flush the queue.
+    """
+    if config.log_rotate_when:
+        handler = logging.handlers.TimedRotatingFileHandler(
+            filename=config.log_file, when=config.log_rotate_when,
+            backupCount=config.log_backup_count, encoding='utf-8')
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            filename=config.log_file, maxBytes=config.log_max_bytes,
+            backupCount=config.log_backup_count, encoding='utf-8')
+    if config.log_json:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    logger = logging.getLogger('discord')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(LogQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    return listener
 
 
 def main():
     """Run the discord bot."""
     # set up logging
-    logger = logging.getLogger('discord')
-    logger.setLevel(logging.INFO)
-    handler = logging.FileHandler(
-        filename='discord.log', encoding='utf-8', mode='a')
-    handler.setFormatter(logging.Formatter(
-        '%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-    logger.addHandler(handler)
+    listener = setup_logging()
 
     # create discord client
     intents = discord.Intents(messages=True, reactions=True, guilds=True, message_content=True)
@@ -44,9 +114,20 @@ def main():
     client = abstractor.Abstractor(
         intents=intents, activity=activity, description=description)
 
+    # keep popular works warm in the cache
+    cache.start_refresher()
+
     # run the bot
     print("Completed setup!")
-    client.run(config.token)
+    try:
+        # log_handler=None stops discord.py from adding its own handler, which writes to stderr
+        client.run(config.token, log_handler=None)
+    finally:
+        # parsing.extract pulls in bs4 and lxml, so it is only imported once an AO3 link is parsed
+        extract = sys.modules.get("parsing.extract")
+        if extract is not None:
+            extract.extraction_pool.shutdown()
+        listener.stop()
 
 
 if __name__ == '__main__':
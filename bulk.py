@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+"""Summarize many fanfiction links at once, without discord.
+
+Reads links from a file (or stdin) and writes one JSON object per line, containing the
+work's metadata and the summary the bot would post. Links to the same work are only fetched once.
+
+Usage:
+    python3 bulk.py links.txt -o recs.jsonl
+    cat links.txt | python3 bulk.py > recs.jsonl
+
+If the output file already exists, pass --resume to skip the links it already contains
+and append the rest. Links that failed are retried.
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import config
+from parsing.common import GlobalParser, LINK_PATTERN
+from parsing.extract import extraction_pool
+from parsing.ratelimit import host_limiter
+
+
+def read_links(lines, global_parser):
+    """
+    Find every link in the input, keeping the first link for each unique id.
+    Returns a list of (unique id, link) tuples in input order.
+    """
+    links = {}
+    for line in lines:
+        for match in LINK_PATTERN.finditer(line):
+            link = match.group(0)
+            unique_id = global_parser.unique_id(link)
+            if unique_id and unique_id not in links:
+                links[unique_id] = link
+    return list(links.items())
+
+
+def read_finished(path):
+    """
+    Return the ids of links that were already summarized successfully in an output file.
+    """
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line may be cut off if the previous run was interrupted
+                continue
+            if "error" not in record:
+                finished.add(record["id"])
+    return finished
+
+
+def summarize(global_parser, unique_id, link) -> dict:
+    """
+    Fetch a single link and build its output record.
+    """
+    try:
+        parsed = global_parser.parse(link)
+        if not parsed:
+            return {"id": unique_id, "link": link, "error": "Could not parse link"}
+        return {
+            "id": unique_id,
+            "link": link,
+            "metadata": parsed.to_record(),
+            "summary": parsed.generate_summary(),
+        }
+    except Exception as e:
+        return {"id": unique_id, "link": link, "error": "{}: {}".format(type(e).__name__, e)}
+
+
+def main():
+    """Summarize the links given on the command line."""
+    arg_parser = argparse.ArgumentParser(description="Summarize fanfiction links as JSON lines.")
+    arg_parser.add_argument("input", nargs="?", default="-",
+                            help="file containing links, or - for stdin (default)")
+    arg_parser.add_argument("-o", "--output", default="-",
+                            help="file to write JSON lines to, or - for stdout (default)")
+    arg_parser.add_argument("-w", "--workers", type=int, default=config.bulk_workers,
+                            help="number of links fetched at the same time")
+    arg_parser.add_argument("-r", "--rate", type=float, default=config.bulk_host_rate,
+                            help="maximum requests per minute to each host contacted (AO3 and FicHub)")
+    arg_parser.add_argument("--resume", action="store_true",
+                            help="skip links already in the output file and append to it")
+    args = arg_parser.parse_args()
+
+    global_parser = GlobalParser()
+    if args.input == "-":
+        links = read_links(sys.stdin, global_parser)
+    else:
+        with open(args.input, encoding="utf-8") as f:
+            links = read_links(f, global_parser)
+
+    if args.output == "-":
+        output = sys.stdout
+    else:
+        if args.resume:
+            finished = read_finished(args.output)
+            links = [(unique_id, link) for unique_id, link in links if unique_id not in finished]
+        output = open(args.output, "a" if args.resume else "w", encoding="utf-8")
+
+    print("Summarizing {} links".format(len(links)), file=sys.stderr)
+    # applies to every request, including chapter lookups, later series pages and FicHub's epub fallback
+    host_limiter.rate = args.rate
+    failed = 0
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    try:
+        futures = [executor.submit(summarize, global_parser, unique_id, link)
+                   for unique_id, link in links]
+        for future in as_completed(futures):
+            record = future.result()
+            if "error" in record:
+                failed += 1
+                print("Failed to parse link: {} ({})".format(record["link"], record["error"]),
+                      file=sys.stderr)
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+    finally:
+        # on interrupt, drop the links that haven't started; finished ones are already written
+        executor.shutdown(cancel_futures=True)
+        extraction_pool.shutdown()
+        if output is not sys.stdout:
+            output.close()
+    print("Done! {} summarized, {} failed".format(len(links) - failed, failed), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -27,3 +27,133 @@ max_links = 3
 
 # The prefix users should use to prevent the bot from responding to a link
 prefix = "!"
+
+# How long (in seconds) parsed works and series are cached before they are fetched again
+cache_ttl = 6 * 60 * 60
+
+# The maximum number of works and series kept in the cache
+cache_max_entries = 5000
+
+# How often (in seconds) the background refresher looks for cached entries about to expire
+refresh_interval = 60
+
+# Popular entries are refreshed when they are within this many seconds of expiring
+refresh_margin = 10 * 60
+
+# Entries requested fewer times than this since they were last loaded are left to expire
+refresh_min_hits = 2
+
+# The maximum number of upstream requests per minute used to refresh popular cache entries
+refresh_budget_per_minute = 10
+
+# The number of links bulk.py fetches at the same time
+bulk_workers = 4
+
+# The maximum number of requests per minute bulk.py makes to each host (AO3, and FicHub for FFN and SB links)
+bulk_host_rate = 30
+
+# Server admins can tag the bot with "backfill <days>" to load works linked in a channel into the cache.
+# The maximum number of days and messages a backfill goes back
+backfill_max_days = 365
+backfill_max_messages = 10000
+
+# The maximum number of upstream requests per minute used by backfills. This is separate from
+# refresh_budget_per_minute, so a long backfill never stops popular entries from being refreshed.
+backfill_budget_per_minute = 10
+
+# How long (in seconds) backfilled works stay cached. Longer than cache_ttl, since a backfill can take days
+# and is meant to cover links reposted long after it. Cache entries are still evicted when the cache is full,
+# so a backfill stops after backfill_max_links links, leaving room in the cache for everything else.
+backfill_ttl = 14 * 24 * 60 * 60
+backfill_max_links = cache_max_entries // 2
+
+# How often (in messages scanned) a backfill logs its progress
+backfill_progress_interval = 500
+
+# How long (in seconds) to wait for a response from a site before giving up
+request_timeout = 20
+
+# How long (in seconds) to remember that a link failed, for each kind of failure, before trying it again
+negative_ttls = {
+    "not_found": 60 * 60,     # deleted works, invalid links
+    "restricted": 30 * 60,    # archive-locked works
+    "upstream": 2 * 60,       # the site or FicHub returned an error
+    "timeout": 60,            # the site or FicHub didn't respond in time
+}
+
+# Circuit breakers stop requests to a site (AO3, FicHub) that is down, so links fail immediately
+# instead of waiting for a timeout. A breaker opens when at least breaker_error_rate of the requests
+# in the last breaker_window seconds failed (once there are at least breaker_min_requests).
+breaker_window = 60
+breaker_min_requests = 5
+breaker_error_rate = 0.5
+
+# How long (in seconds) a breaker stays open before letting breaker_trials requests through to test the site
+breaker_open_time = 30
+breaker_trials = 1
+
+# The number of processes used to extract metadata from AO3 pages. 0 extracts in the bot's own process.
+extract_workers = 2
+
+# Extraction processes are replaced after this many pages, to keep their memory use down
+extract_max_tasks_per_worker = 500
+
+# The maximum number of pages waiting for an extraction process at once
+extract_max_queued = 32
+
+# The maximum time (in seconds) importing bot.py may take, checked by `python3 -m parsing.registry`
+import_budget = 1.5
+
+# Modules that take less time than this (in seconds) to import are left out of the import time report
+import_report_threshold = 0.005
+
+# File where the work each AO3 chapter belongs to is saved, so chapter links only need to be looked up once
+chapter_index_file = "chapter_index.json"
+
+# FicHub's API, used for FFN and SpaceBattles metadata
+fichub_api = "https://fichub.net/api/v0/"
+
+# "meta" requests only metadata from FicHub, falling back to the epub endpoint if that fails.
+# "epub" always uses the epub endpoint, which is much slower as FicHub generates the ebook.
+fichub_mode = "meta"
+
+# File where the url FicHub resolves each link to is saved
+fichub_url_index_file = "fichub_urls.json"
+
+# The number of links fetched at the same time. Servers take turns using these.
+fetch_workers = 4
+
+# The maximum number of links a single server can have waiting to be fetched
+max_queued_per_guild = 10
+
+# How long (in seconds) a link can wait to be fetched before the bot says it is busy
+max_queue_wait = 15
+
+# How many links a single user can post per minute, with bursts of up to user_link_burst. 0 for no limit.
+user_links_per_minute = 12
+user_link_burst = 6
+
+# How often (in seconds) the fetch queue stats of each server are logged
+scheduler_report_interval = 15 * 60
+
+# The number of recent messages whose summaries are remembered, so that links added by editing the message
+# can be summarized without repeating the links that were already there
+tracked_messages = 1000
+
+# The file the bot logs to
+log_file = "discord.log"
+
+# The log file is rotated when it reaches log_max_bytes, or, if log_rotate_when is set, at that interval
+# (e.g. "midnight" for daily, see logging.handlers.TimedRotatingFileHandler). log_backup_count old logs are kept.
+log_max_bytes = 10 * 1024 * 1024
+log_rotate_when = None
+log_backup_count = 5
+
+# Write logs as one JSON object per line instead of plain text
+log_json = False
+
+# The file where the names of server owners are saved between restarts
+guild_owner_file = "guild_owners.json"
+
+# How many server owners can be fetched from discord at the same time when the bot starts
+owner_lookup_concurrency = 5
@@ -27,3 +27,7 @@ HELP = "To trigger this message, tag me and say \"help\" or \"info\"."
 
 ERROR_MESSAGE = """Error on {}.
 If you can access the page in your browser, please @ {}."""
+
+BUSY_MESSAGE = "I'm getting a lot of links right now, please try again in a minute."
+
+BACKFILL_RUNNING_MESSAGE = "A backfill is already running, please wait for it to finish."
@@ -1,13 +1,29 @@
+import hashlib
 import re
 import AO3
+import requests
 import config
-from parsing.common import Parser
+from parsing.breaker import breaker_for
+from parsing.cache import metadata_cache
+from parsing.canonical import canonicalize, chapter_index
+from parsing.registry import AO3_MATCH
+from parsing.common import Parser, FetchError, NOT_FOUND, RESTRICTED, UPSTREAM, TIMEOUT
+from parsing.extract import extraction_pool, extract_series, extract_work
+from parsing.ratelimit import host_limiter
 
 AO3Session = AO3.Session(config.AO3_USERNAME, config.AO3_PASSWORD)
 
-AO3_MATCH = re.compile(  # looks for a valid AO3 link. Group 1 is the type of link, group 2 is the ID.
-    "(?<!{})https?://(?:www\\.)?archiveofourown.org(?:/collections/\\w+)?/(works|series|chapters)/(\\d+)"
-    .format(re.escape(config.prefix)))
+WORK_URL = "https://archiveofourown.org/works/{}?view_adult=true"
+SERIES_URL = "https://archiveofourown.org/series/{}"
+CHAPTER_URL = "https://archiveofourown.org/chapters/{}"
+
+# where AO3 redirects chapter links to. Group 1 is the id of the work.
+CHAPTER_REDIRECT_MATCH = re.compile("/works/(\\d+)/chapters/\\d+")
+
+# parts of AO3's pages that change without the work or series changing, and aren't in its summary:
+# the per-request CSRF tokens, and the hit counts of the work or of every work listed in a series
+VOLATILE_MATCH = re.compile(b'(?<=name="authenticity_token" value=")[^"]*|(?<=name="csrf-token" content=")[^"]*'
+                            b'|(?<=<dd class="hits">)[^<]*')
 
 
 class AO3Parser(Parser):
@@ -23,6 +39,15 @@ class AO3Parser(Parser):
         match = AO3_MATCH.match(link)
         return match is not None
 
+    def unique_id(self, link) -> str:
+        """
+        Returns the id of an AO3 link, in the form ao3:<type>:<id>.
+        Links to chapters whose work is already known use the id of the work.
+        """
+        if not AO3_MATCH.match(link):
+            return None
+        return canonicalize(link).key
+
     def parse(self, link):
         """
         Parse an AO3 link and return a representation of a work, series, or other object.
@@ -37,49 +62,199 @@ class AO3Parser(Parser):
         link_type = match.group(1)
         link_id = match.group(2)
 
-        unique_id = link_type + ":" + link_id
+        # chapters are cached as the work they belong to
+        if link_type == "chapters":
+            link_type = "works"
+            link_id = self._work_id_for_chapter(link_id)
+
+        unique_id = "ao3:" + link_type + ":" + link_id
         if unique_id in self._parsed_objects:
             return self._parsed_objects[unique_id]
 
         # check if link is to a series
         if link_type == "series":
-            parsed = AO3SeriesWrapper(link_id)
+            loader = lambda: AO3SeriesWrapper(link_id)
         # check if link is to a work
         elif link_type == "works":
-            parsed = AO3WorkWrapper(link_id)
-        # check if link is to a chapter
-        elif link_type == "chapters":
-            chapter = AO3.Chapter(link_id, None, AO3Session)
-            parsed = AO3WorkWrapper.from_work(chapter.work)
+            loader = lambda: AO3WorkWrapper(link_id)
         else:
             raise ValueError("Invalid AO3 link")
 
+        parsed = metadata_cache.get_or_load(unique_id, _classify_errors(loader))
+
         if parsed:
             self._parsed_objects[unique_id] = parsed
         return parsed
 
+    @staticmethod
+    def _work_id_for_chapter(chapter_id) -> str:
+        """
+        Find the id of the work a chapter belongs to, looking it up on AO3 the first time.
+        """
+        work_id = chapter_index.get(chapter_id)
+        if work_id is not None:
+            return work_id
+
+        # chapters that couldn't be found are remembered like any other failed link
+        key = "ao3:chapters:" + chapter_id
+        error = metadata_cache.get_failure(key)
+        if error is not None:
+            raise error
+        try:
+            work_id = _classify_errors(lambda: _resolve_chapter(chapter_id))()
+        except FetchError as e:
+            metadata_cache.put_failure(key, e)
+            raise
+
+        chapter_index.set(chapter_id, work_id)
+        return work_id
+
+
+def _classify_errors(loader):
+    """
+    Wrap a loader so that errors from AO3 are raised as FetchErrors, which the cache remembers,
+    and so that it goes through AO3's circuit breaker.
+    """
+    def classified():
+        try:
+            return loader()
+        except AO3.utils.InvalidIdError as e:
+            raise FetchError(str(e), NOT_FOUND) from e
+        except AO3.utils.AuthError as e:
+            raise FetchError(str(e), RESTRICTED) from e
+        except AO3.utils.HTTPError as e:
+            raise FetchError(str(e), UPSTREAM) from e
+        except requests.Timeout as e:
+            raise FetchError("AO3 timed out", TIMEOUT) from e
+        except requests.ConnectionError as e:
+            raise FetchError("Could not connect to AO3", UPSTREAM) from e
+
+    def load():
+        return breaker_for("archiveofourown.org").call(classified)
+    return load
+
+
+def _fetch_page(url) -> bytes:
+    """
+    Download a page from AO3, without parsing it.
+    """
+    return _get_page(url).content
+
+
+def _fetch_changed_page(url, validators: dict) -> tuple[bytes, dict]:
+    """
+    Download a page from AO3 if it has changed since the download the validators (ETag, Last-Modified date
+    and content hash) came from. An empty dict of validators always downloads the page.
+
+    Returns the page, or None if it hasn't changed, and the validators for the page as it is now.
+    The validators should only be kept once the page has been extracted successfully.
+    """
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    response = _get_page(url, headers)
+    if response.status_code == requests.codes.not_modified:
+        metadata_cache.counters["not_modified"] += 1
+        metadata_cache.counters["bytes_saved"] += validators.get("size", 0)
+        return None, validators
+
+    content_hash = _content_hash(response.content)
+    current = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified"),
+               "hash": content_hash, "size": len(response.content)}
+    if content_hash == validators.get("hash"):
+        return None, current
+    return response.content, current
+
+
+def _get_page(url, headers=None) -> requests.Response:
+    """
+    Request a page from AO3, raising a FetchError unless it was found or is unchanged (304).
+    """
+    host_limiter.acquire("archiveofourown.org")
+    response = AO3Session.get(url, headers=headers or {}, timeout=config.request_timeout)
+    if response.status_code == requests.codes.not_modified and headers:
+        return response
+    if response.status_code == 404:
+        raise FetchError("Cannot find {}".format(url), NOT_FOUND)
+    if response.status_code != requests.codes.ok:
+        raise FetchError("AO3 error {}".format(response.status_code), UPSTREAM)
+    # archive-locked works redirect to the login page if we aren't logged in
+    if "/users/login" in response.url:
+        raise FetchError("{} is only available to registered users".format(url), RESTRICTED)
+    return response
+
+
+def _content_hash(page: bytes) -> str:
+    """
+    Hash a page, ignoring the parts of it that change without the work or series changing.
+    """
+    return hashlib.sha256(VOLATILE_MATCH.sub(b"", page)).hexdigest()
+
+
+def _resolve_chapter(chapter_id) -> str:
+    """
+    Find the id of the work a chapter belongs to.
+    AO3 redirects chapter links to /works/<work id>/chapters/<chapter id>, so the redirect is enough,
+    without downloading the chapter.
+    """
+    url = CHAPTER_URL.format(chapter_id)
+    host_limiter.acquire("archiveofourown.org")
+    response = AO3Session.get(url, allow_redirects=False, timeout=config.request_timeout)
+    if response.status_code == 404:
+        raise FetchError("Cannot find {}".format(url), NOT_FOUND)
+    if response.status_code >= 500:
+        raise FetchError("AO3 error {}".format(response.status_code), UPSTREAM)
+    location = response.headers.get("Location", "")
+    if "/users/login" in location:
+        raise FetchError("{} is only available to registered users".format(url), RESTRICTED)
+    match = CHAPTER_REDIRECT_MATCH.search(location)
+    if not match:
+        raise FetchError("Cannot find the work for {}".format(url), NOT_FOUND)
+    return match.group(1)
+
 
 class AO3WorkWrapper:
-    work: AO3.Work
+    # the work's metadata, see extract_work
+    metadata: dict
+
+    def __init__(self, work_id, load=True):
+        self.work_id = work_id
+        self.metadata = None
+        # ETag, Last-Modified and content hash of the work's page, see _fetch_changed_page
+        self.validators = {}
+        if load:
+            self.reload()
+
+    def reload(self):
+        """
+        Download the work's page and extract its metadata in the extraction pool.
+        """
+        page, validators = _fetch_changed_page(WORK_URL.format(self.work_id), {})
+        self.metadata = extraction_pool.run(extract_work, self.work_id, page)
+        self.validators = validators
 
-    @classmethod
-    def from_work(cls, work: AO3.Work):
+    def revalidate(self) -> bool:
         """
-        Create an AO3WorkParser from an existing AO3.Work.
+        Check whether the work's page has changed, and extract its metadata again only if it has.
+        Returns whether it changed.
         """
-        parser = cls.__new__(cls)
-        parser.work = work
-        return parser
+        return _classify_errors(self._revalidate)()
 
-    def __init__(self, work_id):
-        self.work = AO3.Work(work_id, AO3Session)
+    def _revalidate(self) -> bool:
+        page, validators = _fetch_changed_page(WORK_URL.format(self.work_id), self.validators)
+        if page is not None:
+            self.metadata = extraction_pool.run(extract_work, self.work_id, page)
+        self.validators = validators
+        return page is not None
 
     def _get_characters_from_relationships(self) -> set[str]:
         """
         Get the characters that exist in the relationship tags.
         """
         already_listed = set()
-        for relationship in self.work.relationships[:3]:
+        for relationship in self.metadata["relationships"][:3]:
             relationship = relationship.replace(" & ", "/")
             relationship = relationship.split("/")
             for character in relationship:
@@ -92,20 +267,19 @@ class AO3WorkWrapper:
         """
         Generate a summary of the work.
         """
-        output = ":lock:" if self.work.restricted else ""
+        work = self.metadata
+        output = ":lock:" if work["restricted"] else ""
         # Title, link, authors
         output += "**{}** (<https://archiveofourown.org/works/{}>) by **{}**\n" \
-            .format(self.work.title, self.work.id, ", ".join(map(lambda x: x.username, self.work.authors)))
+            .format(work["title"], work["id"], ", ".join(work["authors"]))
         # Series
-        if series := self._series_with_positions():
-            series = series[:2]
-            for s, index in series:
-                output += "**Part {}** of the **{}** series (<https://archiveofourown.org/series/{}>)\n" \
-                    .format(index, s.name, s.id)
+        for s in work["series"][:2]:
+            output += "**Part {}** of the **{}** series (<https://archiveofourown.org/series/{}>)\n" \
+                .format(s["part"], s["name"], s["id"])
 
         # Fandoms
-        if self.work.fandoms:
-            fandoms = self.work.fandoms
+        if work["fandoms"]:
+            fandoms = work["fandoms"]
             if len(fandoms) > 5:
                 fandoms = ", ".join(fandoms[:5]) + ", …"
             else:
@@ -113,30 +287,30 @@ class AO3WorkWrapper:
             output += "**Fandoms:** {}\n".format(fandoms)
 
         # Rating, Warnings, Category
-        rating = self.work.rating
-        if self.work.categories:
-            category = ", ".join(self.work.categories)
+        rating = work["rating"]
+        if work["categories"]:
+            category = ", ".join(work["categories"])
             output += "**Rating:** {}          **Category:** {}\n".format(rating, category)
         else:
             output += "**Rating:** {}\n".format(rating)
 
-        warnings = ", ".join(self.work.warnings)
+        warnings = ", ".join(work["warnings"])
         output += "**Warnings:** {}\n".format(warnings)
 
         # Relationships, Characters
-        if self.work.relationships:
-            relationships = self.work.relationships.copy()
+        if work["relationships"]:
+            relationships = work["relationships"].copy()
             if len(relationships) > 3:
                 relationships = ", ".join(relationships[:3]) + ", …"
             else:
                 relationships = ", ".join(relationships)
             output += "**Relationships:** {}\n".format(relationships)
 
-        if self.work.characters:
+        if work["characters"]:
             # clear out characters that are already listed in relationships
-            characters = self.work.characters.copy()
+            characters = work["characters"].copy()
             already_listed = self._get_characters_from_relationships()
-            for character in self.work.characters:
+            for character in work["characters"]:
                 stripped_character = character
                 if " (" in stripped_character:
                     stripped_character = stripped_character.split(" (")[0]
@@ -146,161 +320,151 @@ class AO3WorkWrapper:
                     characters.remove(character)
 
             if len(characters) > 3:
-                characters = ", ".join(characters[:3]) + ", …"
+                characters = ", ".join(characters[:3]) + ", …"
             else:
                 characters = ", ".join(characters)
 
             if len(characters) > 0:
-                if self.work.relationships:
+                if work["relationships"]:
                     output += "**Additional Characters:** {}\n".format(characters)
                 else:
                     output += "**Characters:** {}\n".format(characters)
 
         # Freeform Tags
-        if self.work.tags:
-            if len(self.work.tags) > 5:
-                freeform = ", ".join(self.work.tags[:5]) + ", …"
+        if work["tags"]:
+            if len(work["tags"]) > 5:
+                freeform = ", ".join(work["tags"][:5]) + ", …"
             else:
-                freeform = ", ".join(self.work.tags)
+                freeform = ", ".join(work["tags"])
             output += "**Tags:** {}\n".format(freeform)
 
         # Summary
-        if self.work.summary:
-            output += "**Summary:** {}\n".format(self._get_formatted_summary())
+        if work["summary"]:
+            output += "**Summary:** {}\n".format(work["summary"])
 
         # Stats
-        expected_chapters = self.work.expected_chapters if self.work.expected_chapters else "?"
-        output += "**Words:** {} **Chapters:** {}/{} **Kudos:** {} **Updated:** {}\n" \
-            .format(self.work.words, self.work.nchapters, expected_chapters,
-                    self.work.kudos, self.work.date_updated.strftime("%Y-%m-%d"))
+        expected_chapters = work["expected_chapters"] if work["expected_chapters"] else "?"
+        output += "**Words:** {} **Chapters:** {}/{} **Kudos:** {} **Updated:** {}\n" \
+            .format(work["words"], work["chapters"], expected_chapters,
+                    work["kudos"], work["updated"])
 
         return output
 
-    def _get_formatted_summary(self):
+    def to_record(self) -> dict:
         """
-        Get the formatted summary of the series.
-        """
-        summary = self.work.soup.find("div", {"class": "summary"})
-        if summary is None:
-            return ""
-        return format_ao3_html(summary)
-
-    def _series_with_positions(self) -> list[tuple[AO3.Series, int]]:
+        Returns the metadata of the work as a plain dictionary.
         """
-        Get the position of the work in the series.
-        """
-
-        # todo: this should be cached but nooooooooooooo the attribute didn't exist
-        # i hate python
-
-        dd = self.work.soup.find("dd", {"class": "series"})
-        if dd is None:
-            return []
-
-        s = []
-        for span in dd.find_all("span", {"class": "position"}):
-            series = AO3.Series(span.a["href"].split("/")[-1], AO3Session)
-            index = re.match(r"Part (\d+)", span.text.strip()).group(1)
-            s.append((series, int(index)))
-
-        self._series_with_positions_cache = s
-        return s
+        record = dict(self.metadata)
+        record["url"] = "https://archiveofourown.org/works/{}".format(self.metadata["id"])
+        return record
 
 
 class AO3SeriesWrapper:
-    series: AO3.Series
-
-    @classmethod
-    def from_series(cls, series: AO3.Series):
-        """
-        Create an AO3SeriesParser from an existing AO3.Series.
-        """
-        parser = cls.__new__(cls)
-        parser.series = series
-        return parser
+    """
+    An AO3 series. Only the first page of the series is loaded, which has the series' details
+    and its first works; later pages are loaded when a work on them is asked for.
+    """
+    # the series' metadata, see extract_series. work_list only has the works on the first page.
+    metadata: dict
 
     def __init__(self, series_id, parse=True):
+        self.metadata = None
+        # page number -> works listed on that page
+        self._pages = {}
+        # ETag, Last-Modified and content hash of the series' first page, see _fetch_changed_page
+        self.validators = {}
         if parse:
             self.parse(series_id)
 
     def parse(self, series_id):
         """
-        Parses a series id into a proper series object.
+        Download the first page of the series and extract its metadata in the extraction pool.
         """
-        self.series = AO3.Series(series_id, AO3Session)
+        page, validators = _fetch_changed_page(SERIES_URL.format(series_id), {})
+        self.metadata = extraction_pool.run(extract_series, series_id, page)
+        self._pages = {1: self.metadata["work_list"]}
+        self.validators = validators
+
+    def revalidate(self) -> bool:
+        """
+        Check whether the series' first page has changed, and extract its metadata again only if it has.
+        Later pages are dropped when it changes, since works may have moved between pages.
+        Returns whether it changed.
+        """
+        return _classify_errors(self._revalidate)()
+
+    def _revalidate(self) -> bool:
+        series_id = self.metadata["id"]
+        page, validators = _fetch_changed_page(SERIES_URL.format(series_id), self.validators)
+        if page is not None:
+            self.metadata = extraction_pool.run(extract_series, series_id, page)
+            self._pages = {1: self.metadata["work_list"]}
+        self.validators = validators
+        return page is not None
+
+    def _works_on_page(self, number) -> list[dict]:
+        """
+        Get the works listed on a page of the series, downloading the page if needed.
+        """
+        if number not in self._pages:
+            url = SERIES_URL.format(self.metadata["id"]) + "?page={}".format(number)
+            page = _classify_errors(lambda: _fetch_page(url))()
+            self._pages[number] = extraction_pool.run(extract_series, self.metadata["id"], page)["work_list"]
+        return self._pages[number]
 
     def generate_summary(self) -> str:
         """
         Generate a summary of the series.
         """
-        output = ":lock:" if self.series.soup.find("img", {"title": "Restricted"}) is not None else ""
+        series = self.metadata
+        output = ":lock:" if series["restricted"] else ""
         # Title, link, authors
         output += "**{}** (<{}>) by **{}**\n" \
-            .format(self.series.name, self.series.url, ", ".join(map(lambda x: x.username, self.series.creators)))
+            .format(series["name"], series["url"], ", ".join(series["creators"]))
 
-        if self.series.description:
-            output += "**Description:** {}\n".format(self.series.description)
+        if series["description"]:
+            output += "**Description:** {}\n".format(series["description"])
 
         # date created, date updated
-        output += "**Begun:** {} **Updated:** {}\n".format(self.series.series_begun, self.series.series_updated)
+        output += "**Begun:** {} **Updated:** {}\n".format(series["begun"], series["updated"])
 
         # stats
         output += "**Words:** {} **Works:** {} **Complete:** {}\n\n".format(
-            self.series.words, self.series.nworks, "Yes" if self.series.complete else "No")
+            series["words"], series["works"], "Yes" if series["complete"] else "No")
 
         # Find titles and links to first few works
-        for i in range(min(3, len(self.series.work_list))):
-            work = self.series.work_list[i]
+        work_list = series["work_list"]
+        for i in range(min(3, len(work_list))):
+            work = work_list[i]
             output += "{}. __{}__: <{}>\n".format(
-                i + 1, work.title, work.url)
+                i + 1, work["title"], work["url"])
         # add the fourth work if there are four works, or else ellipsis
-        if len(self.series.work_list) == 4:
-            work = self.series.work_list[3]
+        if len(work_list) == 4:
+            work = work_list[3]
             output += "4. __{}__: <{}>".format(
-                work.title, work.url)
-        elif len(self.series.work_list) > 4:
-            output += "        [and {} more works]".format(self.series.nworks - 3)
+                work["title"], work["url"])
+        elif len(work_list) > 4:
+            output += "        [and {} more works]".format(series["works"] - 3)
 
         return output
 
+    def to_record(self) -> dict:
+        """
+        Returns the metadata of the series as a plain dictionary.
+        """
+        return dict(self.metadata)
+
     def get_work(self, number):
         """
         Get the work at the given number in the series.
         """
-        work = self.series.work_list[number - 1]
-        work.reload()
-        return AO3WorkWrapper.from_work(work)
-
-
-def format_ao3_html(field):
-    """
-    Format an HTML segment for discord markdown.
-
-    field should be a note or summary from AO3.
-    """
-    brs = field.find_all("br")
-    for br in brs:
-        br.replace_with("\n")
-    ols = field.find_all("ol")
-    for ol in ols:
-        ol.name = "p"
-    uls = field.find_all("ul")
-    for ul in uls:
-        ul.name = "p"
-    for li in field.find_all("li"):
-        li.string = "- {}".format(li.text.strip())
-        li.unwrap()
-    field = field.blockquote.find_all("p")
-    result = list(map(lambda x: x.text.strip(), field))
-    result = "\n\n".join(result)
-    result = result.strip()
-    while "\n\n\n" in result:
-        result = result.replace("\n\n\n", "\n\n")
-    if result.count("\n\n") > 2:
-        result = "\n\n".join(result.split("\n\n")[:3])
-    if len(result) > 250:
-        result = result[:250].strip()
-        # i = result.rfind(" ")
-        # result = result[:i]
-        result += "…"
-    return result
+        if number < 1 or number > self.metadata["works"]:
+            raise IndexError("Series {} has no work {}".format(self.metadata["id"], number))
+        # every page but the last is full, so the first page says how many works there are per page
+        per_page = len(self.metadata["work_list"])
+        if not per_page:
+            raise IndexError("Series {} lists no works".format(self.metadata["id"]))
+        page, index = divmod(number - 1, per_page)
+        work_id = str(self._works_on_page(page + 1)[index]["id"])
+        return metadata_cache.get_or_load("ao3:works:" + work_id,
+                                          _classify_errors(lambda: AO3WorkWrapper(work_id)))
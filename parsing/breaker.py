@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+from collections import Counter, deque
+
+import config
+from parsing.common import FetchError, UPSTREAM, TIMEOUT, UNAVAILABLE
+
+logger = logging.getLogger('discord')
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """
+    Stops requests to an upstream host that is failing, so they fail immediately
+    instead of each waiting for a timeout.
+
+    The breaker opens when at least `error_rate` of the requests in the last `window` seconds
+    failed with an upstream error or timeout (once there have been at least `min_requests`).
+    After `open_time` seconds it lets `trials` requests through; if they succeed it closes again,
+    and if any fail it stays open for another `open_time` seconds.
+    """
+
+    def __init__(self, host, window=None, min_requests=None, error_rate=None, open_time=None, trials=None):
+        self.host = host
+        self.window = window if window is not None else config.breaker_window
+        self.min_requests = min_requests if min_requests is not None else config.breaker_min_requests
+        self.error_rate = error_rate if error_rate is not None else config.breaker_error_rate
+        self.open_time = open_time if open_time is not None else config.breaker_open_time
+        self.trials = trials if trials is not None else config.breaker_trials
+        self.state = CLOSED
+        self.counters = Counter()
+        # (time, succeeded) for each request in the current window
+        self._results = deque()
+        self._opened_at = 0.0
+        self._trials_started = 0
+        self._trials_succeeded = 0
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        """
+        Change state, logging the transition.
+        """
+        if state == self.state:
+            return
+        logger.warning("Circuit breaker for {} is now {} (was {})".format(self.host, state, self.state))
+        self.counters["to_" + state] += 1
+        self.state = state
+        self._results.clear()
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        elif state == HALF_OPEN:
+            self._trials_started = 0
+            self._trials_succeeded = 0
+
+    def _allow(self) -> bool:
+        """
+        Decide whether a request may go through, moving from open to half-open if it's time.
+        """
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.open_time:
+                self._set_state(HALF_OPEN)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and self._trials_started < self.trials:
+                self._trials_started += 1
+                return True
+            return False
+
+    def _record(self, succeeded):
+        """
+        Record the result of a request and update the state.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.state == HALF_OPEN:
+                if not succeeded:
+                    self._set_state(OPEN)
+                else:
+                    self._trials_succeeded += 1
+                    if self._trials_succeeded >= self.trials:
+                        self._set_state(CLOSED)
+                return
+            if self.state != CLOSED:
+                return
+
+            self._results.append((now, succeeded))
+            while self._results and self._results[0][0] < now - self.window:
+                self._results.popleft()
+            failures = sum(1 for _, ok in self._results if not ok)
+            if len(self._results) >= self.min_requests and failures / len(self._results) >= self.error_rate:
+                self._set_state(OPEN)
+
+    def call(self, func):
+        """
+        Call func through the breaker. Raises a FetchError with failure UNAVAILABLE if the breaker is open.
+        Only upstream errors and timeouts count as failures; a missing work means the host is working.
+        """
+        if not self._allow():
+            self.counters["rejected"] += 1
+            raise FetchError("{} is unavailable".format(self.host), UNAVAILABLE)
+        try:
+            result = func()
+        except FetchError as e:
+            self.counters[e.failure] += 1
+            self._record(e.failure not in (UPSTREAM, TIMEOUT))
+            raise
+        except Exception:
+            # parsing errors and the like don't say anything about the host
+            self._record(True)
+            raise
+        self.counters["ok"] += 1
+        self._record(True)
+        return result
+
+    def stats(self) -> dict:
+        """
+        Return the breaker's state and counters.
+        """
+        stats = dict(self.counters)
+        stats["state"] = self.state
+        return stats
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(host) -> CircuitBreaker:
+    """
+    Return the shared circuit breaker for an upstream host.
+    """
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
+
+
+def breaker_stats() -> dict:
+    """
+    Return the state and counters of every circuit breaker, by host.
+    """
+    with _breakers_lock:
+        return {host: breaker.stats() for host, breaker in _breakers.items()}
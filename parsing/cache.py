@@ -0,0 +1,279 @@
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import config
+from parsing.breaker import breaker_stats, CLOSED
+from parsing.common import FetchError, NOT_FOUND, RESTRICTED, UPSTREAM, TIMEOUT, UNAVAILABLE
+from parsing.ratelimit import RateLimiter
+
+logger = logging.getLogger('discord')
+
+
+class CacheEntry:
+    """
+    A single cached object, along with the function used to load it again.
+    """
+    __slots__ = ("value", "loader", "expires", "hits")
+
+    def __init__(self, value, loader, expires):
+        self.value = value
+        self.loader = loader
+        self.expires = expires
+        # number of times the entry has been requested since it was last loaded
+        self.hits = 0
+
+
+class MetadataCache:
+    """
+    Shared cache of parsed works, series and FicHub entries, keyed by a unique id.
+
+    Entries expire after `ttl` seconds. Each entry remembers how to load itself, so that
+    popular entries can be refreshed in the background before they expire (see CacheRefresher).
+
+    Failed loads are cached too, for a length of time depending on the kind of failure,
+    so that reposts of a broken link fail without fetching it again.
+    Expired entries are kept until they are evicted, and served if the upstream site is down.
+    """
+
+    def __init__(self, ttl=None, max_entries=None, negative_ttls=None):
+        self.ttl = ttl if ttl is not None else config.cache_ttl
+        self.max_entries = max_entries if max_entries is not None else config.cache_max_entries
+        self.negative_ttls = negative_ttls if negative_ttls is not None else config.negative_ttls
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        # key is the unique id, value is the (FetchError, expiry time) of the last failed load
+        self._failures: OrderedDict[str, tuple[FetchError, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = Counter()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Return the cached object for a key, or None if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires <= time.monotonic():
+                return None
+            entry.hits += 1
+            self._entries.move_to_end(key)
+            return entry.value
+
+    def get_stale(self, key):
+        """
+        Return the cached object for a key even if it has expired, or None if it is missing.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.value if entry is not None else None
+
+    def put(self, key, value, loader):
+        """
+        Store an object in the cache. loader is a callable with no arguments that returns a fresh copy.
+        """
+        with self._lock:
+            self._entries[key] = CacheEntry(value, loader, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def extend(self, key, ttl):
+        """
+        Keep an entry until at least ttl seconds from now, if it is cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.expires = max(entry.expires, time.monotonic() + ttl)
+
+    def get_failure(self, key) -> FetchError:
+        """
+        Return the cached error for a key that recently failed to load, or None.
+        """
+        with self._lock:
+            failure = self._failures.get(key)
+            if failure is None:
+                return None
+            error, expires = failure
+            if expires <= time.monotonic():
+                del self._failures[key]
+                return None
+            return error
+
+    def put_failure(self, key, error: FetchError):
+        """
+        Remember that a key failed to load. Failures without a configured ttl,
+        like an open circuit breaker, are not cached.
+        """
+        self.counters["failure:" + error.failure] += 1
+        ttl = self.negative_ttls.get(error.failure)
+        if not ttl:
+            return
+        with self._lock:
+            self._failures[key] = (error, time.monotonic() + ttl)
+            self._failures.move_to_end(key)
+            while len(self._failures) > self.max_entries:
+                self._failures.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        """
+        Return the cached object for a key, loading and storing it first if needed.
+        Raises the cached FetchError without loading if the key failed recently.
+        If the upstream site is down, an expired copy is returned instead, if there is one.
+        """
+        value = self.get(key)
+        if value is not None:
+            self.counters["hits"] += 1
+            return value
+
+        error = self.get_failure(key)
+        if error is not None:
+            self.counters["negative_hits"] += 1
+        else:
+            self.counters["misses"] += 1
+            try:
+                value = loader()
+            except FetchError as e:
+                self.put_failure(key, e)
+                error = e
+            else:
+                if value:
+                    self.put(key, value, loader)
+                return value
+
+        if error.failure in (UPSTREAM, TIMEOUT, UNAVAILABLE):
+            value = self.get_stale(key)
+            if value is not None:
+                self.counters["stale_hits"] += 1
+                return value
+        raise error
+
+    def stats(self) -> dict:
+        """
+        Return the cache's counters, along with the number of cached entries and failures.
+        """
+        stats = dict(self.counters)
+        stats["entries"] = len(self._entries)
+        stats["failures"] = len(self._failures)
+        return stats
+
+    def refresh_candidates(self, margin, min_hits=1) -> list[str]:
+        """
+        Return the keys of entries that expire within `margin` seconds, most requested first.
+        Entries requested fewer than min_hits times since they were loaded are left to expire.
+        """
+        deadline = time.monotonic() + margin
+        with self._lock:
+            candidates = [(entry.hits, key) for key, entry in self._entries.items()
+                          if entry.expires <= deadline and entry.hits >= min_hits]
+        candidates.sort(reverse=True)
+        return [key for _, key in candidates]
+
+    def refresh(self, key):
+        """
+        Reload an entry using its loader. The old value is kept if reloading fails.
+        Objects with a revalidate method are asked to update themselves instead,
+        which avoids downloading and parsing them again if they haven't changed.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return
+        try:
+            if hasattr(entry.value, "revalidate"):
+                value = entry.value
+                self.counters["revalidated"] += 1
+                if not value.revalidate():
+                    self.counters["reparses_avoided"] += 1
+            else:
+                value = entry.loader()
+        except FetchError as e:
+            # stop serving works that have been deleted or locked since they were cached
+            if e.failure in (NOT_FOUND, RESTRICTED):
+                with self._lock:
+                    self._entries.pop(key, None)
+                self.put_failure(key, e)
+            raise
+        if value:
+            self.put(key, value, entry.loader)
+
+
+class CacheRefresher(threading.Thread):
+    """
+    Background thread that refreshes the most popular cache entries shortly before they expire,
+    so they are never fetched cold while a user is waiting.
+
+    Refreshes are limited to `budget` upstream requests per minute.
+    """
+
+    def __init__(self, cache: MetadataCache, budget: RateLimiter, interval=None, margin=None, min_hits=None):
+        super().__init__(name="cache-refresher", daemon=True)
+        self.cache = cache
+        self.budget = budget
+        self.interval = interval if interval is not None else config.refresh_interval
+        self.margin = margin if margin is not None else config.refresh_margin
+        self.min_hits = min_hits if min_hits is not None else config.refresh_min_hits
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        """
+        Stop the refresher after the current pass.
+        """
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.refresh_once()
+
+    def refresh_once(self) -> int:
+        """
+        Refresh as many expiring entries as the budget allows. Returns the number refreshed.
+        """
+        refreshed = 0
+        failed = 0
+        for key in self.cache.refresh_candidates(self.margin, self.min_hits):
+            if not self.budget.try_acquire():
+                break
+            try:
+                self.cache.refresh(key)
+                refreshed += 1
+            except FetchError as e:
+                failed += 1
+                logger.info("Could not refresh cached entry: {} ({}: {})".format(key, e.failure, e))
+            except Exception:
+                failed += 1
+                logger.exception("Failed to refresh cached entry: {}".format(key))
+        breakers = breaker_stats()
+        # during an outage every refresh fails, which is when the breakers' stats matter most
+        if refreshed or failed or any(stats["state"] != CLOSED for stats in breakers.values()):
+            logger.info("Refreshed {} cached entries, {} failed. Cache stats: {} Circuit breakers: {}".format(
+                refreshed, failed, self.cache.stats(), breakers))
+        return refreshed
+
+
+# shared cache used by all parsers
+metadata_cache = MetadataCache()
+
+# upstream requests per minute that the refresher is allowed to use
+background_budget = RateLimiter(config.refresh_budget_per_minute)
+
+# upstream requests per minute that backfills are allowed to use
+backfill_budget = RateLimiter(config.backfill_budget_per_minute)
+
+_refresher = None
+
+
+def start_refresher():
+    """
+    Start the background refresher for the shared cache, if it is not already running.
+    """
+    global _refresher
+    if _refresher is None:
+        _refresher = CacheRefresher(metadata_cache, background_budget)
+        _refresher.start()
+    return _refresher
@@ -0,0 +1,137 @@
+"""
+Canonical forms of links.
+
+The same work can be linked in many ways: with or without www., through an AO3 collection or
+chapter, on FFN's mobile site or a later chapter, or to a page or post of a SpaceBattles thread.
+canonicalize maps all of them to one key, which is used for caching and deduplication,
+and one url, which is used for fetching.
+
+Run `python3 -m parsing.canonical` to check that generated variants of links all map to the same key.
+"""
+
+from typing import NamedTuple
+
+import config
+from parsing.registry import AO3_MATCH, FFN_MATCH, SB_MATCH
+from parsing.store import JsonStore
+
+# chapter id -> id of the AO3 work it belongs to
+chapter_index = JsonStore(config.chapter_index_file)
+
+
+class CanonicalLink(NamedTuple):
+    # unique id of the linked object, e.g. ao3:works:123, ffn:456 or sb:789
+    key: str
+    # the link in its canonical form
+    url: str
+
+
+def canonicalize(link) -> CanonicalLink:
+    """
+    Return the canonical key and url of a link, or None if it isn't a link to a supported site.
+    """
+    for site in (_ao3, _ffn, _sb):
+        canonical = site(link)
+        if canonical:
+            return canonical
+    return None
+
+
+def _ao3(link) -> CanonicalLink:
+    """
+    AO3 works, series and chapters. Chapters whose work is known are the work.
+    """
+    match = AO3_MATCH.match(link)
+    if not match:
+        return None
+    link_type, link_id = match.group(1), match.group(2)
+    if link_type == "chapters" and link_id in chapter_index:
+        link_type, link_id = "works", chapter_index.get(link_id)
+    return CanonicalLink("ao3:{}:{}".format(link_type, link_id),
+                         "https://archiveofourown.org/{}/{}".format(link_type, link_id))
+
+
+def _ffn(link) -> CanonicalLink:
+    """
+    FFN stories, from any chapter and either site.
+    """
+    match = FFN_MATCH.match(link)
+    if not match:
+        return None
+    return CanonicalLink("ffn:" + match.group(1), "https://www.fanfiction.net/s/" + match.group(1))
+
+
+def _sb(link) -> CanonicalLink:
+    """
+    SpaceBattles threads, from any page or post. Threads are identified by the number at the end
+    of the thread's slug (e.g. some-title.12345), since the title part can change.
+    """
+    match = SB_MATCH.match(link)
+    if not match:
+        return None
+    thread = match.group(1).rstrip(".")
+    thread_id = thread.rsplit(".", 1)[-1]
+    if not thread_id.isdigit():
+        thread_id = thread
+    return CanonicalLink("sb:" + thread_id, "https://forums.spacebattles.com/threads/{}/".format(thread))
+
+
+# templates for generating variants of links, with the choices for each part
+VARIANTS = [
+    ("{scheme}://{host}/{collection}{kind}/{id}{suffix}", {
+        "host": ["archiveofourown.org", "www.archiveofourown.org"],
+        "collection": ["", "collections/Some_Collection/", "collections/abc123/"],
+        "kind": ["works", "series"],
+        "id": ["1", "123456", "98765432"],
+        "suffix": ["", "/", "?view_adult=true", "/chapters/98765", "/chapters/98765#workskin"],
+    }),
+    ("{scheme}://{host}/s/{id}{suffix}", {
+        "host": ["fanfiction.net", "www.fanfiction.net", "m.fanfiction.net"],
+        "id": ["1", "13579", "12345678"],
+        "suffix": ["", "/", "/1", "/3/", "/3/Some-Title", "/12/Another-Title-Here"],
+    }),
+    ("{scheme}://{host}/threads/{slug}{id}{suffix}", {
+        "host": ["forums.spacebattles.com", "spacebattles.com", "www.spacebattles.com"],
+        "slug": ["", "title.", "a-longer-title.", "title.with.dots.", "title-2."],
+        "id": ["1", "987654", "1111"],
+        "suffix": ["", "/", "/page-12", "/page-3#post-123456", "/threadmarks", "/reader/", "#post-1"],
+    }),
+]
+
+
+def _variants(template, choices, rng, count=100):
+    """
+    Generate random variants of a link, grouped by the parts that identify the linked object.
+    Yields (identifying parts, link) tuples.
+    """
+    for _ in range(count):
+        parts = {name: rng.choice(options) for name, options in choices.items()}
+        parts["scheme"] = rng.choice(["http", "https"])
+        identity = (template, parts.get("kind"), parts["id"])
+        yield identity, template.format(**parts)
+
+
+if __name__ == '__main__':
+    import random
+
+    rng = random.Random(0)
+    # identifying parts -> key of the first variant seen
+    keys = {}
+    failures = 0
+    checked = 0
+    for template, choices in VARIANTS:
+        for identity, link in _variants(template, choices, rng):
+            checked += 1
+            canonical = canonicalize(link)
+            expected = keys.setdefault(identity, canonical.key if canonical else None)
+            # every variant must have the same key, and the canonical url must be its own canonical form
+            if canonical is None or canonical.key != expected or canonicalize(canonical.url) != canonical:
+                failures += 1
+                print("{} -> {}, expected {}".format(link, canonical, expected))
+    # different objects must have different keys
+    if len(set(keys.values())) != len(keys):
+        failures += 1
+        print("Different links share a key: {}".format(keys))
+    print("Checked {} variants of {} links, {} failed".format(checked, len(keys), failures))
+    if failures:
+        raise SystemExit(1)
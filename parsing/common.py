@@ -1,12 +1,52 @@
+import re
 from abc import abstractmethod
 from functools import cached_property
+from urllib.parse import urlparse
 
 import requests
 
 import config
+from parsing.ratelimit import host_limiter
+from parsing.store import JsonStore
 
 HEADER = {"User-Agent": config.name}
 
+# Sites that the bot should attempt to parse links from
+# The parser is ultimately responsible for determining if a link is valid,
+# but this is used as a first pass to avoid unnecessary parsing.
+# Exclude any prefixes (http://, https://, www.) and any subdomains (m., forums.) from this list.
+VALID_SITES = [
+    "archiveofourown.org",
+    "fanfiction.net",
+    "spacebattles.com"
+]
+
+# The regular expression to identify possible website links
+# matches https://, then an optional subdomain, then a site name, then any non-whitespace characters
+# the negative lookahead prevents the bot from responding to links that start with the prefix (! by default)
+LINK_PATTERN = re.compile(
+    "(?<!{})https?://(?:\\S*\\.)?(?:{})\\S*".format(
+        re.escape(config.prefix), "|".join([re.escape(link) for link in VALID_SITES])))
+
+# Kinds of failure when fetching a work. Each is cached for its own length of time, see config.negative_ttls
+NOT_FOUND = "not_found"
+RESTRICTED = "restricted"
+UPSTREAM = "upstream"
+TIMEOUT = "timeout"
+# the upstream host's circuit breaker is open, so it wasn't contacted
+UNAVAILABLE = "unavailable"
+
+
+class FetchError(ValueError):
+    """
+    Raised when a work, series, or other object can't be fetched.
+    failure is one of NOT_FOUND, RESTRICTED, UPSTREAM, TIMEOUT or UNAVAILABLE.
+    """
+
+    def __init__(self, message, failure):
+        super().__init__(message)
+        self.failure = failure
+
 class Parser:
     """
     Abstract class for parsers.
@@ -31,6 +71,11 @@ class Parser:
         """Return the parsed objects."""
         return list(self._parsed_objects.values())
 
+    @property
+    def parsed_items(self) -> list[tuple[str, any]]:
+        """Return the unique ids and parsed objects, in the order they were parsed."""
+        return list(self._parsed_objects.items())
+
     @property
     def num_processed(self):
         """Return the number of unique links processed."""
@@ -43,6 +88,14 @@ class Parser:
         """
         pass
 
+    @abstractmethod
+    def unique_id(self, link) -> str:
+        """
+        Return the id that a link is cached under, or None if this parser can't handle the link.
+        Links to the same work, series, or other object share the same id.
+        """
+        pass
+
     @abstractmethod
     def parse(self, link):
         """
@@ -66,16 +119,9 @@ class GlobalParser(Parser):
     def __init__(self):
         super().__init__()
         # import here to avoid circular imports
-        from parsing.ao3 import AO3Parser
-        from parsing.ffn import FFNParser
-        from parsing.sb import SBParser
-        # initialize parsers
-        self.parsers = [
-            AO3Parser(),
-            FFNParser(),
-            SBParser()
-            # SVParser()
-        ]
+        from parsing.registry import SITES, LazyParser
+        # initialize parsers; each site's module is only imported once one of its links is parsed
+        self.parsers = [LazyParser(site) for site in SITES]
 
     def _get_parser_by_link(self, link) -> any:
         """
@@ -94,6 +140,15 @@ class GlobalParser(Parser):
         """
         return True if self._get_parser_by_link(link) else False
 
+    def unique_id(self, link) -> str:
+        """
+        Returns the id the matching parser caches the link under, or None if no parser matches.
+        """
+        parser = self._get_parser_by_link(link)
+        if not parser:
+            return None
+        return parser.unique_id(link)
+
     def parse(self, link) -> any:
         """
         Parse a link or id and return a representation of a work, series, or other object.
@@ -106,7 +161,9 @@ class GlobalParser(Parser):
         if not parser:
             return None
 
-        return parser.parse(link)
+        # import here to avoid circular imports
+        from parsing.canonical import canonicalize
+        return parser.parse(canonicalize(link).url)
 
     def generate_summaries(self, limit=3) -> list[str]:
         """
@@ -133,6 +190,16 @@ class GlobalParser(Parser):
                 parsed_objects.append(item)
         return parsed_objects
 
+    @property
+    def parsed_items(self) -> list[tuple[str, any]]:
+        """
+        returns the unique ids and parsed objects from all the parsers, in the order summaries are generated
+        """
+        parsed_items = []
+        for parser in self.parsers:
+            parsed_items.extend(parser.parsed_items)
+        return parsed_items
+
     @property
     def num_processed(self):
         """
@@ -141,6 +208,10 @@ class GlobalParser(Parser):
         return len(self.parsed_objects)
 
 
+# link -> the url FicHub resolved it to
+fichub_urls = JsonStore(config.fichub_url_index_file)
+
+
 class FicHubWork:
     """
     Represents a fic from FicHub, with properties to access the metadata.
@@ -162,10 +233,56 @@ class FicHubWork:
                 if attr in self.__dict__:
                     delattr(self, attr)
 
-        response = requests.get(f"https://fichub.net/api/v0/epub?q={self.url}", headers=HEADER)
+        # import here to avoid circular imports
+        from parsing.breaker import breaker_for
+        self.metadata = breaker_for("fichub.net").call(self._fetch_metadata)
+
+    def _fetch_metadata(self):
+        """
+        Requests the metadata of this work from FicHub.
+
+        The metadata endpoint is used if config.fichub_mode is "meta", falling back to the much slower
+        epub endpoint (which generates an ebook) if that fails. The url FicHub resolves the link to
+        is remembered, so later requests for the same link don't have to be resolved again.
+        """
+        query = fichub_urls.get(self.url, self.url)
+        metadata = None
+        if config.fichub_mode == "meta":
+            metadata = self._request_metadata("meta", query)
+        if metadata is None:
+            metadata = self._request_metadata("epub", query)
+        if metadata is None:
+            raise FetchError("Invalid link", NOT_FOUND)
+
+        if metadata.get("source"):
+            fichub_urls.set(self.url, metadata["source"])
+        return metadata
+
+    @staticmethod
+    def _request_metadata(endpoint, query):
+        """
+        Requests metadata from one of FicHub's endpoints. Returns None if FicHub doesn't know the link.
+        Raises a FetchError if FicHub is failing or rate limiting us.
+        """
+        host_limiter.acquire(urlparse(config.fichub_api).hostname)
+        try:
+            response = requests.get(config.fichub_api + endpoint, params={"q": query}, headers=HEADER,
+                                    timeout=config.request_timeout)
+        except requests.Timeout as e:
+            raise FetchError("FicHub timed out", TIMEOUT) from e
+        except requests.ConnectionError as e:
+            raise FetchError("Could not connect to FicHub", UPSTREAM) from e
+        # timeouts, rate limiting and server errors say nothing about the link, so they aren't cached as not found
+        if response.status_code == requests.codes.request_timeout:
+            raise FetchError("FicHub timed out", TIMEOUT)
+        if response.status_code == requests.codes.too_many_requests or response.status_code >= 500:
+            raise FetchError("FicHub error {}".format(response.status_code), UPSTREAM)
         if response.status_code != requests.codes.ok:
-            raise ValueError("Invalid link")
-        self.metadata = response.json()["meta"]
+            return None
+        try:
+            return response.json().get("meta")
+        except ValueError:
+            return None
 
     def generate_summary(self):
         """
@@ -183,6 +300,21 @@ class FicHubWork:
 
         return output
 
+    def to_record(self) -> dict:
+        """
+        Returns the metadata of the fic as a plain dictionary.
+        """
+        return {
+            "title": self.title,
+            "author": self.author,
+            "url": self.url,
+            "summary": self.summary,
+            "status": self.status,
+            "chapters": self.chapters,
+            "words": self.words,
+            "updated": self.updated,
+        }
+
     @cached_property
     def title(self):
         """
@@ -252,3 +384,85 @@ def atoi(text):
         return int(text.replace(",", "").replace(".", "").replace(" ", ""))
     except ValueError:
         return 0
+
+
+if __name__ == '__main__':
+    # Check that each FFN and SB link costs exactly one call to FicHub's metadata endpoint, against a local
+    # stand-in for FicHub. Run with `python3 -m parsing.common`.
+    import http.server
+    import json
+    import os
+    import tempfile
+    import threading
+    from collections import Counter
+    from urllib.parse import parse_qs
+
+    # use the package's copy of this module, which the parsers import, rather than this __main__ copy
+    import parsing.common
+    from parsing.registry import LazyParser, SITES
+
+    requests_seen = Counter()
+
+    class StandIn(http.server.BaseHTTPRequestHandler):
+        """Answers FicHub API requests with made-up metadata. Links containing "missing" only work as epubs."""
+
+        def do_GET(self):
+            path, _, query = self.path.partition("?")
+            endpoint = path.rsplit("/", 1)[-1]
+            link = parse_qs(query)["q"][0]
+            requests_seen[endpoint, link] += 1
+            if endpoint == "meta" and "missing" in link:
+                self.send_response(404)
+                self.end_headers()
+                return
+            meta = {"title": "Title", "author": "Author", "description": "<p>Summary</p>", "status": "ongoing",
+                    "chapters": 3, "words": 12345, "updated": "2024-01-01T00:00:00",
+                    "extraMeta": "Rated: Fiction T - English - Genre: Drama - Favs: 10", "source": link}
+            body = json.dumps({"meta": meta}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config.fichub_api = "http://127.0.0.1:{}/api/v0/".format(server.server_port)
+    config.fichub_mode = "meta"
+    parsing.common.fichub_urls = JsonStore(os.path.join(tempfile.mkdtemp(), "fichub_urls.json"))
+
+    links = ["https://www.fanfiction.net/s/1001/1/Title", "https://m.fanfiction.net/s/1001/4",
+             "https://www.fanfiction.net/s/1002",
+             "https://forums.spacebattles.com/threads/a-title.2001/", "https://spacebattles.com/threads/2001/page-3",
+             "https://forums.spacebattles.com/threads/missing.2002/"]
+    failures = 0
+    # the second pass uses new parsers, as the bot does for every message, so it has to be served by the cache
+    for _ in range(2):
+        parsers = [LazyParser(site) for site in SITES]
+        for link in links:
+            parser = next(parser for parser in parsers if parser.is_valid_link(link))
+            work = parser.parse(link)
+            work.generate_summary()
+            work.to_record()
+
+    meta_calls = {link: count for (endpoint, link), count in requests_seen.items() if endpoint == "meta"}
+    epub_calls = {link: count for (endpoint, link), count in requests_seen.items() if endpoint == "epub"}
+    # four works, most linked in several forms, and each should cost exactly one metadata call
+    expected_meta = {"https://www.fanfiction.net/s/1001": 1, "https://www.fanfiction.net/s/1002": 1,
+                     "https://forums.spacebattles.com/threads/a-title.2001/": 1,
+                     "https://forums.spacebattles.com/threads/missing.2002/": 1}
+    # only the work the metadata endpoint doesn't know falls back to the epub endpoint, once
+    expected_epub = {"https://forums.spacebattles.com/threads/missing.2002/": 1}
+    if meta_calls != expected_meta:
+        failures += 1
+        print("Metadata calls: {}, expected {}".format(meta_calls, expected_meta))
+    if epub_calls != expected_epub:
+        failures += 1
+        print("Epub calls: {}, expected {}".format(epub_calls, expected_epub))
+    print("Parsed {} links to {} works with {} FicHub requests, {} checks failed".format(
+        len(links) * 2, len(expected_meta), sum(requests_seen.values()), failures))
+    server.shutdown()
+    if failures:
+        raise SystemExit(1)
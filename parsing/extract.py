@@ -0,0 +1,365 @@
+"""
+Extraction of metadata from AO3 pages.
+
+Parsing AO3 pages with BeautifulSoup is CPU-bound, so the raw page is handed to a pool of
+worker processes, which send back a plain dictionary of the metadata the bot needs.
+The extract_* functions must stay importable without logging in to AO3, since every worker imports them.
+
+Run `python3 -m parsing.extract <work or series page.html>...` to benchmark throughput against worker count,
+or `python3 -m parsing.extract --series 300` to benchmark loading only the first page of a long series.
+"""
+
+import multiprocessing
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from bs4 import BeautifulSoup
+
+import config
+
+
+def _soup(page):
+    """
+    Parse a page, unless it is already a BeautifulSoup object.
+    """
+    if isinstance(page, BeautifulSoup):
+        return page
+    return BeautifulSoup(page, "lxml")
+
+
+def _tags(meta, name) -> list[str]:
+    """
+    Get the text of every tag in a work's tag list, e.g. fandom or relationship.
+    """
+    dd = meta.find("dd", {"class": name}) if meta else None
+    if dd is None:
+        return []
+    return [a.text.strip() for a in dd.find_all("a", {"class": "tag"})]
+
+
+def _stat(stats, name) -> str:
+    """
+    Get the text of a single statistic, e.g. words or kudos, or an empty string if it is missing.
+    """
+    dd = stats.find("dd", {"class": name}) if stats else None
+    return dd.text.strip() if dd else ""
+
+
+def _number(text) -> int:
+    """
+    Convert a number from AO3, which may contain separators, to an int, or else return 0.
+    """
+    try:
+        return int(text.replace(",", "").replace(".", "").replace(" ", ""))
+    except ValueError:
+        return 0
+
+
+def _usernames(links) -> list[str]:
+    """
+    Get the usernames from links to users' pseuds, e.g. /users/name/pseuds/pseud.
+    """
+    return [a["href"].split("/")[2] for a in links if a.get("href", "").startswith("/users/")]
+
+
+def extract_work(work_id, page) -> dict:
+    """
+    Extract the metadata of a work from its page.
+    """
+    soup = _soup(page)
+    meta = soup.find("dl", {"class": "work meta group"})
+    stats = soup.find("dl", {"class": "stats"})
+    title = soup.find("h2", {"class": "title heading"})
+    byline = soup.find("h3", {"class": "byline heading"})
+
+    chapters = _stat(stats, "chapters").split("/")
+    ratings = _tags(meta, "rating")
+    updated = _stat(stats, "status") or _stat(stats, "published")
+
+    series = []
+    dd = meta.find("dd", {"class": "series"}) if meta else None
+    if dd is not None:
+        for span in dd.find_all("span", {"class": "position"}):
+            part = re.match(r"Part (\d+)", span.text.strip())
+            series.append({
+                "id": span.a["href"].split("/")[-1],
+                "name": span.a.text.strip(),
+                "part": int(part.group(1)) if part else 0,
+            })
+
+    summary = soup.find("div", {"class": "summary"})
+
+    return {
+        "id": int(work_id),
+        "title": title.text.strip() if title else "",
+        "authors": _usernames(byline.find_all("a", {"rel": "author"})) if byline else [],
+        "restricted": title is not None and title.find("img", {"title": "Restricted"}) is not None,
+        "fandoms": _tags(meta, "fandom"),
+        "rating": ratings[0] if ratings else "",
+        "categories": _tags(meta, "category"),
+        "warnings": _tags(meta, "warning"),
+        "relationships": _tags(meta, "relationship"),
+        "characters": _tags(meta, "character"),
+        "tags": _tags(meta, "freeform"),
+        "summary": format_ao3_html(summary) if summary is not None else "",
+        "words": _number(_stat(stats, "words")),
+        "chapters": _number(chapters[0]),
+        "expected_chapters": _number(chapters[1]) if len(chapters) > 1 and chapters[1] != "?" else None,
+        "kudos": _number(_stat(stats, "kudos")),
+        "updated": updated,
+        "series": series,
+    }
+
+
+def extract_series(series_id, page) -> dict:
+    """
+    Extract the metadata of a series from one of its pages, including the works listed on that page.
+    """
+    soup = _soup(page)
+    name = soup.find("h2", {"class": "heading"})
+    meta = soup.find("dl", {"class": "series meta group"})
+
+    # the series meta is a list of labels (dt) and values (dd), e.g. "Series Begun:" and a date
+    fields = {}
+    if meta is not None:
+        for dt in meta.find_all("dt", recursive=False):
+            dd = dt.find_next_sibling("dd")
+            if dd is not None:
+                fields[dt.text.strip().rstrip(":")] = dd
+    stats = meta.find("dl", {"class": "stats"}) if meta else None
+    creators = fields.get("Creators") or fields.get("Creator")
+    description = fields.get("Description")
+    description = description.find("blockquote") if description else None
+
+    work_list = []
+    index = soup.find("ul", {"class": "series work index group"})
+    if index is not None:
+        for blurb in index.find_all("li", {"class": "work"}, recursive=False):
+            link = blurb.find("h4", {"class": "heading"}).find("a", href=re.compile(r"^/works/\d+"))
+            work_id = link["href"].split("/")[-1]
+            work_list.append({
+                "id": int(work_id),
+                "title": link.text.strip(),
+                "url": "https://archiveofourown.org/works/{}".format(work_id),
+            })
+
+    # long series are split into pages of works
+    pagination = soup.find("ol", {"class": "pagination"})
+    pages = [_number(a.text) for a in pagination.find_all("a")] if pagination else []
+
+    return {
+        "id": int(series_id),
+        "name": name.text.strip() if name else "",
+        "url": "https://archiveofourown.org/series/{}".format(series_id),
+        "creators": _usernames(creators.find_all("a")) if creators else [],
+        "restricted": soup.find("img", {"title": "Restricted"}) is not None,
+        "description": description.text.strip() if description else "",
+        "begun": fields["Series Begun"].text.strip() if "Series Begun" in fields else "",
+        "updated": fields["Series Updated"].text.strip() if "Series Updated" in fields else "",
+        "words": _number(_stat(stats, "words")),
+        "works": _number(_stat(stats, "works")),
+        "complete": _stat(stats, "complete") == "Yes",
+        "work_list": work_list,
+        "pages": max(pages, default=1),
+    }
+
+
+def format_ao3_html(field):
+    """
+    Format an HTML segment for discord markdown.
+
+    field should be a note or summary from AO3.
+    """
+    brs = field.find_all("br")
+    for br in brs:
+        br.replace_with("\n")
+    ols = field.find_all("ol")
+    for ol in ols:
+        ol.name = "p"
+    uls = field.find_all("ul")
+    for ul in uls:
+        ul.name = "p"
+    for li in field.find_all("li"):
+        li.string = "- {}".format(li.text.strip())
+        li.unwrap()
+    field = field.blockquote.find_all("p")
+    result = list(map(lambda x: x.text.strip(), field))
+    result = "\n\n".join(result)
+    result = result.strip()
+    while "\n\n\n" in result:
+        result = result.replace("\n\n\n", "\n\n")
+    if result.count("\n\n") > 2:
+        result = "\n\n".join(result.split("\n\n")[:3])
+    if len(result) > 250:
+        result = result[:250].strip()
+        # i = result.rfind(" ")
+        # result = result[:i]
+        result += "…"
+    return result
+
+
+class ExtractionPool:
+    """
+    Runs extract_* functions in a pool of worker processes.
+
+    Workers are replaced after `max_tasks_per_worker` pages, to keep their memory in check.
+    At most `max_queued` pages wait for a worker at once; callers beyond that block until there is room.
+    With no workers, pages are extracted in the calling thread instead.
+    """
+
+    def __init__(self, workers=None, max_tasks_per_worker=None, max_queued=None):
+        self.workers = workers if workers is not None else config.extract_workers
+        self.max_tasks_per_worker = max_tasks_per_worker if max_tasks_per_worker is not None \
+            else config.extract_max_tasks_per_worker
+        self._slots = threading.BoundedSemaphore(max_queued if max_queued is not None else config.extract_max_queued)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        """
+        Start the worker processes the first time they are needed.
+        """
+        with self._lock:
+            if self._executor is None:
+                # max_tasks_per_child can't be used with forked workers
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    max_tasks_per_child=self.max_tasks_per_worker)
+            return self._executor
+
+    def run(self, func, *args):
+        """
+        Run func(*args) in a worker process and return the result.
+        """
+        if self.workers <= 0:
+            return func(*args)
+        with self._slots:
+            executor = self._get_executor()
+            try:
+                return executor.submit(func, *args).result()
+            except BrokenProcessPool:
+                # a worker died, e.g. killed for using too much memory; start a new pool and try once more
+                with self._lock:
+                    if self._executor is executor:
+                        self._executor = None
+                executor.shutdown(wait=False)
+                return self._get_executor().submit(func, *args).result()
+
+    def shutdown(self, wait=True):
+        """
+        Stop the worker processes, letting them finish the pages they are working on if wait is True.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+# shared pool used by the AO3 parser
+extraction_pool = ExtractionPool()
+
+
+def _benchmark(paths, worker_counts, pages=200):
+    """
+    Print pages extracted per second for each number of workers.
+    """
+    samples = []
+    for path in paths:
+        with open(path, "rb") as f:
+            page = f.read()
+        is_series = b'class="series meta group"' in page
+        samples.append((extract_series if is_series else extract_work, page))
+
+    for workers in worker_counts:
+        pool = ExtractionPool(workers=workers, max_queued=max(workers, 1) * 2)
+        # start the workers before timing
+        pool.run(*_benchmark_args(samples, 0))
+        threads = []
+        start = time.perf_counter()
+        for i in range(pages):
+            thread = threading.Thread(target=pool.run, args=_benchmark_args(samples, i))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        pool.shutdown()
+        print("{:>2} workers: {:7.1f} pages/s".format(workers, pages / elapsed))
+
+
+def _benchmark_args(samples, i):
+    """
+    Arguments for ExtractionPool.run for the i-th benchmark page.
+    """
+    func, page = samples[i % len(samples)]
+    return func, 1, page
+
+
+def _series_page(works, first, last, pages):
+    """
+    Build a series page listing works first to last, shaped like AO3's.
+    """
+    blurbs = "".join(
+        '<li class="work blurb group"><div class="header module"><h4 class="heading">'
+        '<a href="/works/{0}">Work {0}</a> by <a rel="author" href="/users/author/pseuds/author">author</a>'
+        '</h4></div><blockquote class="userstuff summary"><p>{1}</p></blockquote>'
+        '<ul class="tags commas">{2}</ul></li>'.format(
+            i, "A summary of the work. " * 20, '<li><a class="tag" href="/tags/x">Tag</a></li>' * 15)
+        for i in range(first, last + 1))
+    pagination = '<ol class="pagination">{}</ol>'.format(
+        "".join('<li><a href="?page={0}">{0}</a></li>'.format(i) for i in range(1, pages + 1)))
+    return ('<html><body><h2 class="heading">Series</h2><dl class="series meta group">'
+            '<dt>Creator:</dt><dd><a rel="author" href="/users/author/pseuds/author">author</a></dd>'
+            '<dt>Series Begun:</dt><dd>2020-01-01</dd><dt>Series Updated:</dt><dd>2024-01-01</dd>'
+            '<dt>Stats:</dt><dd><dl class="stats"><dt>Words:</dt><dd class="words">1,000,000</dd>'
+            '<dt>Works:</dt><dd class="works">{}</dd><dt>Complete:</dt><dd class="complete">No</dd></dl></dd>'
+            '</dl><ul class="series work index group">{}</ul>{}</body></html>'
+            .format(works, blurbs, pagination)).encode()
+
+
+def _benchmark_series(works, per_page=20):
+    """
+    Compare extracting every work of a long series with extracting only its first page.
+    """
+    import tracemalloc
+
+    pages = -(-works // per_page)
+    runs = [
+        ("all {} works on one page".format(works), _series_page(works, 1, works, 1)),
+        ("first page of {}".format(pages), _series_page(works, 1, min(works, per_page), pages)),
+    ]
+    for name, page in runs:
+        tracemalloc.start()
+        start = time.perf_counter()
+        metadata = extract_series(1, page)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("{:>30}: {:7.1f} ms, peak {:6.1f} MiB, {} works listed".format(
+            name, elapsed * 1000, peak / 2 ** 20, len(metadata["work_list"])))
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+
+    arg_parser = argparse.ArgumentParser(description="Benchmark extraction throughput against worker count.")
+    arg_parser.add_argument("pages", nargs="*", help="saved AO3 work or series pages")
+    arg_parser.add_argument("-n", "--count", type=int, default=200, help="number of pages to extract per run")
+    arg_parser.add_argument("-w", "--workers", type=int, nargs="+",
+                            default=sorted({0, 1, 2, 4, os.cpu_count() or 1}),
+                            help="worker counts to try; 0 extracts in the calling thread")
+    arg_parser.add_argument("-s", "--series", type=int, metavar="WORKS",
+                            help="instead, compare the time and memory used to extract a generated series "
+                                 "with this many works in full and only its first page")
+    args = arg_parser.parse_args()
+    if args.series:
+        _benchmark_series(args.series)
+    elif args.pages:
+        _benchmark(args.pages, args.workers, args.count)
+    else:
+        arg_parser.error("give some pages to benchmark, or --series")
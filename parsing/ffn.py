@@ -1,13 +1,9 @@
-import re
 from functools import cached_property
-import config
+from parsing.cache import metadata_cache
+from parsing.canonical import canonicalize
+from parsing.registry import FFN_MATCH
 from parsing.common import Parser, FicHubWork
 
-FFN_MATCH = re.compile(  # looks for a valid FFN link. Group 1 is the id of the work
-    "(?<!{})https?://(?:www\\.|m\\.)?fanfiction.net/s/(\\d+)[^ ]*"
-    .format(re.escape(config.prefix)))
-
-
 class FFNParser(Parser):
     """
     Parser for fanfiction.net links.
@@ -20,6 +16,14 @@ class FFNParser(Parser):
         match = FFN_MATCH.match(link)
         return match is not None
 
+    def unique_id(self, link) -> str:
+        """
+        Returns the id of an FFN link, in the form ffn:<id>.
+        """
+        if not FFN_MATCH.match(link):
+            return None
+        return canonicalize(link).key
+
     def parse(self, link):
         """
         Parse an FFN link and return a representation of the fic.
@@ -29,12 +33,12 @@ class FFNParser(Parser):
         if not match:
             raise ValueError("Invalid FFN link")
 
-        unique_id = match.group(1)
+        unique_id = self.unique_id(link)
 
         if unique_id in self._parsed_objects:
             return self._parsed_objects[unique_id]
 
-        parsed = FFNWork(unique_id)
+        parsed = metadata_cache.get_or_load(unique_id, lambda: FFNWork(match.group(1)))
 
         if parsed:
             self._parsed_objects[unique_id] = parsed
@@ -44,12 +48,8 @@ class FFNParser(Parser):
 class FFNWork(FicHubWork):
 
     def __init__(self, fic_id, load=True):
-        super().__init__(fic_id, load)
+        super().__init__("https://www.fanfiction.net/s/" + fic_id, load)
         self.fic_id = fic_id
-        self.url = "https://www.fanfiction.net/s/" + fic_id
-        self.metadata = None
-        if load:
-            self.reload()
 
     def generate_summary(self):
         """
@@ -76,6 +76,19 @@ class FFNWork(FicHubWork):
 
         return output
 
+    def to_record(self) -> dict:
+        """
+        Returns the metadata of the fic as a plain dictionary.
+        """
+        record = super().to_record()
+        record.update({
+            "rating": self.rating,
+            "genre": self.genre,
+            "characters": self.characters,
+            "favs": self.favs,
+        })
+        return record
+
     @cached_property
     def stats(self):
         """
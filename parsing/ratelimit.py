@@ -0,0 +1,85 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket.
+
+    Allows up to `rate` requests per `per` seconds, with bursts of up to `burst` requests
+    (defaults to `rate`).
+    """
+
+    def __init__(self, rate, per=60.0, burst=None):
+        self.rate = rate
+        self.per = per
+        self.capacity = burst if burst is not None else rate
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        """
+        Add the tokens that have accumulated since the last refill.
+        """
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate / self.per)
+
+    def try_acquire(self) -> bool:
+        """
+        Take a token if one is available. Never blocks.
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def is_full(self) -> bool:
+        """
+        Returns whether the bucket is full, which means it behaves like a new limiter.
+        """
+        with self._lock:
+            self._refill()
+            return self._tokens >= self.capacity
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one becomes available.
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) * self.per / self.rate
+            time.sleep(wait)
+
+
+class HostLimiter:
+    """
+    Rate limits requests separately for every upstream host. A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host):
+        """
+        Wait until a request may be made to the given host.
+        """
+        if not self.rate:
+            return
+        with self._lock:
+            limiter = self._limiters.setdefault(host, RateLimiter(self.rate, burst=1))
+        limiter.acquire()
+
+
+# every request to an upstream site goes through this. It is unlimited unless a rate is set, e.g. by bulk.py
+host_limiter = HostLimiter()
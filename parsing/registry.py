@@ -0,0 +1,154 @@
+"""
+Registry of the sites the bot can parse.
+
+Each site declares the pattern its links match here, which is cheap to import.
+The site's parser module, which may pull in heavy dependencies or log in to the site,
+is only imported the first time a matching link is seen.
+
+Run `python3 -m parsing.registry` to report how long importing bot.py, the entry point, takes, per module.
+It exits with an error if the total is over config.import_budget.
+"""
+
+import importlib
+import re
+
+import config
+from parsing.common import Parser
+
+AO3_MATCH = re.compile(  # looks for a valid AO3 link. Group 1 is the type of link, group 2 is the ID.
+    "(?<!{})https?://(?:www\\.)?archiveofourown\\.org(?:/collections/[^/\\s]+)?/(works|series|chapters)/(\\d+)"
+    .format(re.escape(config.prefix)))
+
+FFN_MATCH = re.compile(  # looks for a valid FFN link. Group 1 is the id of the work
+    "(?<!{})https?://(?:www\\.|m\\.)?fanfiction\\.net/s/(\\d+)[^ ]*"
+    .format(re.escape(config.prefix)))
+
+SB_MATCH = re.compile(  # looks for a valid SB link. Group 1 is the thread's slug, ending in its id
+    "(?<!{})https?://(?:forums\\.|www\\.)?spacebattles\\.com/threads/([-.\\w]+)/?[^ ]*"
+    .format(re.escape(config.prefix)))
+
+
+class Site:
+    """
+    A site the bot can parse: the pattern its links match, and where to find its parser.
+    """
+
+    def __init__(self, name, pattern, module, parser):
+        self.name = name
+        self.pattern = pattern
+        self.module = module
+        self.parser = parser
+
+    def matches(self, link) -> bool:
+        """
+        Returns true if the link belongs to this site.
+        """
+        return self.pattern.match(link) is not None
+
+    def load(self) -> type:
+        """
+        Import the site's parser module and return its parser class.
+        """
+        return getattr(importlib.import_module(self.module), self.parser)
+
+
+SITES = [
+    Site("ao3", AO3_MATCH, "parsing.ao3", "AO3Parser"),
+    Site("ffn", FFN_MATCH, "parsing.ffn", "FFNParser"),
+    Site("sb", SB_MATCH, "parsing.sb", "SBParser"),
+]
+
+
+class LazyParser(Parser):
+    """
+    Stands in for a site's parser, creating the real one when the first matching link is parsed.
+    """
+
+    def __init__(self, site: Site):
+        super().__init__()
+        self.site = site
+        self._parser = None
+
+    @property
+    def loaded(self) -> bool:
+        """
+        Returns whether the site's parser has been created.
+        """
+        return self._parser is not None
+
+    @property
+    def parser(self) -> Parser:
+        """
+        Returns the site's parser, importing and creating it if needed.
+        """
+        if self._parser is None:
+            self._parser = self.site.load()()
+        return self._parser
+
+    def clear(self):
+        if self.loaded:
+            self._parser.clear()
+
+    @property
+    def parsed_objects(self) -> list[any]:
+        return self._parser.parsed_objects if self.loaded else []
+
+    @property
+    def parsed_items(self) -> list[tuple[str, any]]:
+        return self._parser.parsed_items if self.loaded else []
+
+    @property
+    def num_processed(self):
+        return self._parser.num_processed if self.loaded else 0
+
+    def is_valid_link(self, link) -> bool:
+        return self.site.matches(link)
+
+    def unique_id(self, link) -> str:
+        if not self.site.matches(link):
+            return None
+        # import here to avoid circular imports
+        from parsing.canonical import canonicalize
+        return canonicalize(link).key
+
+    def parse(self, link):
+        return self.parser.parse(link)
+
+    def generate_summaries(self, limit=3) -> list[str]:
+        return self._parser.generate_summaries(limit) if self.loaded else []
+
+
+def import_times(module="bot") -> list[tuple[str, float]]:
+    """
+    Import a module in a fresh interpreter and return the cumulative import time of every module
+    it imported, in seconds. Modules are listed after the modules they imported, and indented by depth.
+    """
+    import subprocess
+    import sys
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            capture_output=True, text=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        # lines look like "import time:       123 |       4567 | module.name"
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        if cumulative.strip().isdigit():
+            # nested imports are indented further than the single space after the separator
+            times.append((name[1:].rstrip(), int(cumulative) / 1_000_000))
+    return times
+
+
+if __name__ == '__main__':
+    import sys
+
+    module = sys.argv[1] if len(sys.argv) > 1 else "bot"
+    times = import_times(module)
+    for name, seconds in times:
+        if seconds >= config.import_report_threshold:
+            print("{:8.1f} ms  {}".format(seconds * 1000, name))
+    total = max((seconds for name, seconds in times if name == module), default=0)
+    print("Importing {} took {:.1f} ms (budget {:.1f} ms)".format(module, total * 1000, config.import_budget * 1000))
+    if total > config.import_budget:
+        sys.exit(1)
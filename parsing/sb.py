@@ -1,11 +1,8 @@
-import re
-import config
+from parsing.cache import metadata_cache
+from parsing.canonical import canonicalize
+from parsing.registry import SB_MATCH
 from parsing.common import Parser, FicHubWork
 
-SB_MATCH = re.compile(  # looks for a valid SB link. Group 1 is the id of the work
-    "(?<!{})https?://forums.spacebattles.com/threads/([-.\\w]+)/?[^ ]*"
-    .format(re.escape(config.prefix)))
-
 class SBParser(Parser):
     """
     Parser for spacebattles.com links.
@@ -18,6 +15,14 @@ class SBParser(Parser):
         match = SB_MATCH.match(link)
         return match is not None
 
+    def unique_id(self, link) -> str:
+        """
+        Returns the id of an SB link, in the form sb:<thread id>.
+        """
+        if not SB_MATCH.match(link):
+            return None
+        return canonicalize(link).key
+
     def parse(self, link):
         """
         Parse an SB link and return a representation of the fic.
@@ -27,12 +32,12 @@ class SBParser(Parser):
         if not match:
             raise ValueError("Invalid SB link")
 
-        unique_id = match.group(1)
+        unique_id = self.unique_id(link)
 
         if unique_id in self._parsed_objects:
             return self._parsed_objects[unique_id]
 
-        parsed = SBWork(unique_id)
+        parsed = metadata_cache.get_or_load(unique_id, lambda: SBWork(match.group(1).rstrip(".")))
 
         if parsed:
             self._parsed_objects[unique_id] = parsed
@@ -44,4 +49,4 @@ class SBWork(FicHubWork):
     Represents a work on SB. FicHubWork does most of the work.
     """
     def __init__(self, fic_id, load=True):
-        super().__init__("https://forums.spacebattles.com/threads/" + fic_id, load)
+        super().__init__("https://forums.spacebattles.com/threads/" + fic_id + "/", load)
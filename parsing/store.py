@@ -0,0 +1,57 @@
+import json
+import os
+import threading
+
+
+class JsonStore:
+    """
+    A dictionary that is saved to a JSON file whenever it changes, so it survives restarts.
+    Keys must be strings, and values must be JSON serializable.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._data = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self._data = json.load(f)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """
+        Return the value for a key, or default if it isn't stored.
+        """
+        return self._data.get(key, default)
+
+    def set(self, key, value):
+        """
+        Store a value and save the file.
+        """
+        with self._lock:
+            if self._data.get(key) == value:
+                return
+            self._data[key] = value
+            self._save()
+
+    def update(self, values: dict):
+        """
+        Store several values and save the file once.
+        """
+        with self._lock:
+            self._data.update(values)
+            self._save()
+
+    def _save(self):
+        """
+        Write the file, replacing the old one only once the new one is complete.
+        """
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self._data, f)
+        os.replace(temp_path, self.path)
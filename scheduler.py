@@ -0,0 +1,167 @@
+"""The scheduler shares the bot's fetch workers fairly between servers.
+
+Fetching and parsing links blocks, so it runs on a pool of worker threads. Each server gets its
+own queue, and free workers take jobs from the queues in turn, so one busy server can't make
+everyone else wait behind its links. Links that wait too long are dropped, and the user is asked
+to try again later.
+"""
+
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from parsing.ratelimit import RateLimiter
+
+logger = logging.getLogger('discord')
+
+
+class SchedulerBusy(Exception):
+    """Raised when a fetch can't be run soon enough, and the user should try again later."""
+
+
+class Job:
+    """A single fetch waiting to run."""
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.queued_at = time.monotonic()
+        loop = asyncio.get_running_loop()
+        self.started = loop.create_future()
+        self.result = loop.create_future()
+
+
+class FetchScheduler:
+    """Runs fetches on a thread pool, taking turns between servers."""
+
+    def __init__(self, workers=None, max_queued=None, max_wait=None, user_rate=None, user_burst=None):
+        self.workers = workers if workers is not None else config.fetch_workers
+        self.max_queued = max_queued if max_queued is not None else config.max_queued_per_guild
+        self.max_wait = max_wait if max_wait is not None else config.max_queue_wait
+        self.user_rate = user_rate if user_rate is not None else config.user_links_per_minute
+        self.user_burst = user_burst if user_burst is not None else config.user_link_burst
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="fetch")
+        self._running = 0
+        # guild id -> jobs waiting to run
+        self._queues: dict[int, deque[Job]] = {}
+        # guilds with waiting jobs, in the order they get their next turn
+        self._turns: deque[int] = deque()
+        self._user_limits: dict[int, RateLimiter] = {}
+        # guild id -> counters, e.g. jobs run and total milliseconds waited
+        self.metrics: dict[int, Counter] = {}
+
+    async def submit(self, guild_id, user_id, func, *args):
+        """Run func(*args) on a worker thread when it's the guild's turn, and return the result.
+
+        Raises SchedulerBusy if the user has posted too many links recently,
+        the guild already has too many links waiting, or the link waited too long to start.
+        """
+        metrics = self.metrics.setdefault(guild_id, Counter())
+        if self.user_rate:
+            limiter = self._user_limits.setdefault(user_id, RateLimiter(self.user_rate, burst=self.user_burst))
+            if not limiter.try_acquire():
+                metrics["user_limited"] += 1
+                raise SchedulerBusy("User {} is posting links too quickly".format(user_id))
+        queue = self._queues.setdefault(guild_id, deque())
+        if len(queue) >= self.max_queued:
+            metrics["rejected"] += 1
+            raise SchedulerBusy("Guild {} has too many links waiting".format(guild_id))
+
+        job = Job(func, args)
+        queue.append(job)
+        if guild_id not in self._turns:
+            self._turns.append(guild_id)
+        metrics["max_depth"] = max(metrics["max_depth"], len(queue))
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(job.started), self.max_wait)
+        except asyncio.TimeoutError:
+            self._remove(guild_id, job)
+            metrics["timed_out"] += 1
+            raise SchedulerBusy("Link waited more than {} seconds in guild {}".format(self.max_wait, guild_id))
+        except asyncio.CancelledError:
+            self._remove(guild_id, job)
+            raise
+        return await job.result
+
+    def _remove(self, guild_id, job):
+        """Take a job that hasn't started out of its guild's queue."""
+        queue = self._queues.get(guild_id)
+        if queue is None or job not in queue:
+            return
+        queue.remove(job)
+        if not queue:
+            del self._queues[guild_id]
+            self._turns.remove(guild_id)
+
+    def _dispatch(self):
+        """Start waiting jobs while there are free workers, one guild at a time."""
+        loop = asyncio.get_running_loop()
+        while self._running < self.workers and self._turns:
+            guild_id = self._turns.popleft()
+            queue = self._queues[guild_id]
+            job = queue.popleft()
+            if queue:
+                self._turns.append(guild_id)
+            else:
+                del self._queues[guild_id]
+
+            metrics = self.metrics[guild_id]
+            waited = time.monotonic() - job.queued_at
+            metrics["jobs"] += 1
+            metrics["wait_ms"] += int(waited * 1000)
+            metrics["max_wait_ms"] = max(metrics["max_wait_ms"], int(waited * 1000))
+
+            self._running += 1
+            job.started.set_result(None)
+            future = loop.run_in_executor(self._executor, job.func, *job.args)
+            future.add_done_callback(lambda f, job=job: self._finished(job, f))
+
+    def _finished(self, job, future):
+        """Pass on a finished job's result and start the next job."""
+        self._running -= 1
+        if not job.result.cancelled():
+            if future.exception() is not None:
+                job.result.set_exception(future.exception())
+            else:
+                job.result.set_result(future.result())
+        self._dispatch()
+
+    def stats(self) -> dict:
+        """Return each guild's current queue depth and counters, with the average wait in ms."""
+        stats = {}
+        for guild_id, metrics in self.metrics.items():
+            guild_stats = dict(metrics)
+            guild_stats["depth"] = len(self._queues.get(guild_id, ()))
+            if metrics["jobs"]:
+                guild_stats["avg_wait_ms"] = metrics["wait_ms"] // metrics["jobs"]
+            stats[guild_id] = guild_stats
+        return stats
+
+    def prune_user_limits(self):
+        """Forget the rate limits of users who haven't posted links recently.
+
+        A full bucket allows as much as a new one, so nothing is lost by dropping it.
+        """
+        for user_id, limiter in list(self._user_limits.items()):
+            if limiter.is_full():
+                del self._user_limits[user_id]
+
+    async def report(self, interval=None):
+        """Log the stats of every guild that used the scheduler, every interval seconds.
+        Idle user rate limits are pruned at the same time.
+        """
+        interval = interval if interval is not None else config.scheduler_report_interval
+        while True:
+            await asyncio.sleep(interval)
+            self.prune_user_limits()
+            if self.metrics:
+                logger.info("Fetch scheduler: {} running, by guild: {}".format(self._running, self.stats()))
+
+    def shutdown(self):
+        """Stop the worker threads once the running jobs are done."""
+        self._executor.shutdown(wait=False, cancel_futures=True)